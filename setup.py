@@ -23,5 +23,6 @@ setuptools.setup(
     package_dir={"": "src"},
     install_requires=["dask", "pandas", "numpy"],
     packages=setuptools.find_packages(where="src"),
+    entry_points={"console_scripts": ["nisicd=nisicd.pipeline:main"]},
     python_requires=">=3.6",
 )
@@ -0,0 +1,66 @@
+"""
+Uncompressed Arrow IPC (Feather v2) copies of cached parquet stages
+
+Downstream readers memory-map the copy instead of decompressing the parquet
+file again. Columns that don't need conversion (numeric without nulls,
+categorical codes) are handed to pandas without copying, so processes reading
+the same cache file share its pages through the OS page cache.
+"""
+import os
+from typing import List
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from nisicd import logging
+
+# Whether stages write an Arrow copy next to each parquet cache file
+write_arrow_copies = True
+
+
+def get_arrow_path(parquet_path: str) -> str:
+    return f"{os.path.splitext(parquet_path)[0]}.arrow"
+
+
+def write_arrow_copy(parquet_path: str) -> None:
+    """
+    Stream a parquet file into its uncompressed Arrow copy, one batch at a time
+    """
+    if not write_arrow_copies:
+        return
+
+    pf = pq.ParquetFile(parquet_path)
+    arrow_path = get_arrow_path(parquet_path)
+    tmp_path = f"{arrow_path}.{os.getpid()}.tmp"
+
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, pf.schema_arrow) as writer:
+            for batch in pf.iter_batches():
+                writer.write_batch(batch)
+
+    os.replace(tmp_path, arrow_path)
+
+
+def read_cache(parquet_path: str, columns: List[str] = None) -> pd.DataFrame:
+    """
+    Read a cached stage, from its memory-mapped Arrow copy if there's one at
+    least as new as the parquet file, otherwise from the parquet file itself
+    """
+    arrow_path = get_arrow_path(parquet_path)
+
+    if (
+        not os.path.exists(arrow_path)
+        or os.stat(arrow_path).st_mtime_ns < os.stat(parquet_path).st_mtime_ns
+    ):
+        return pd.read_parquet(parquet_path, columns=columns)
+
+    logging.info(f"Memory-mapping {arrow_path}")
+    with pa.memory_map(arrow_path, "r") as source:
+        table = pa.ipc.open_file(source).read_all()
+
+    if columns is not None:
+        table = table.select(columns)
+
+    # split_blocks keeps pandas from consolidating (and so copying) columns
+    return table.to_pandas(split_blocks=True)
@@ -1,3 +1,8 @@
+import numpy as np
+import pandas as pd
+
+from nisicd.dataProcessing.icdMatcher import IcdMatcher
+
 CCI = {
     "Myocardial infarction": {
         "Match Codes": ["I252"],
@@ -545,3 +550,20 @@ CCI = {
         "Points": 6,
     },
 }
+
+
+cci_matcher = IcdMatcher(
+    exact_codes={k: v["Match Codes"] for k, v in CCI.items()},
+    prefix_codes={k: v["Startswith Codes"] for k, v in CCI.items()},
+)
+cci_points = np.array([CCI[label]["Points"] for label in cci_matcher.labels])
+
+
+def get_cci_scores(df: pd.DataFrame, dx_cols: list) -> np.ndarray:
+    """
+    Per-row CCI scores over the given dx columns
+
+    Each code scores every category it hits (by exact match, prefix, or both)
+    once, and a row's score is the sum over all of its codes
+    """
+    return cci_matcher.counts(df, dx_cols) @ cci_points
@@ -1,5 +1,7 @@
 import re
 
+from nisicd.dataProcessing.columnRegistry import column_registry
+
 ssi_codes = [
     "9985",
     "99851",
@@ -90,6 +92,13 @@ DX_CODES = {
     # "postoperative_infection": ["9985", "99851", "99859"]
 }
 
+# Prolonged LOS is LOS above this percentile for the presenting condition
+prolonged_los_quantile = 0.9
+
+# If set, inclusion criteria and processing stream the cohort this many rows at
+# a time (out-of-core) rather than reading it into memory all at once
+chunk_size = None
+
 
 def get_proc_cols(all_cols):
     icd9_proc_cols = [col for col in all_cols if re.search("^PR[0-9]{1,2}$", col)]
@@ -98,13 +107,19 @@ def get_proc_cols(all_cols):
     return icd9_proc_cols + icd10_proc_cols
 
 
+dx_col_patterns = ["^DX[0-9]{1,2}$", "^I10_DX[0-9]{1,2}$"]
+
+
 def get_dx_cols(all_cols):
-    icd9_cols = [col for col in all_cols if re.search("^DX[0-9]{1,2}$", col)]
-    icd10_cols = [col for col in all_cols if re.search("^I10_DX[0-9]{1,2}$", col)]
+    icd9_cols = [col for col in all_cols if re.search(dx_col_patterns[0], col)]
+    icd10_cols = [col for col in all_cols if re.search(dx_col_patterns[1], col)]
 
     return icd9_cols + icd10_cols
 
 
+column_registry.require("dx_cols", patterns=dx_col_patterns)
+
+
 categorical_lookup = {
     "SEX": ["Male", "Female", "Unknown"],
     "RACE": [
@@ -157,3 +172,26 @@ composite_comorbidities = {
     "PERIPHERAL VASCULAR": ("CMR_PERIVASC", "CM_PERIVASC"),
     "HYPOTHYROIDISM": ("CMR_THYROID_HYPO", "CM_HYPOTHY"),
 }
+
+column_registry.require(
+    "composite_comorbidities",
+    cols=[c for cols in composite_comorbidities.values() for c in cols],
+)
+
+# Raw columns the process stage carries over as-is (aside from dtype)
+process_copy_cols = [
+    "AGE",
+    "APRDRG_Severity",
+    "APRDRG_Risk_Mortality",
+    "DIED",
+    "PAY1",
+    "RACE",
+    "FEMALE",
+    "HOSP_LOCTEACH",
+    "HOSP_REGION",
+]
+
+column_registry.require(
+    "process",
+    cols=process_copy_cols + ["ZIPINC", "ZIPINC_QRTL", "I10_NPR", "NPR", "LOS"],
+)
@@ -0,0 +1,166 @@
+"""
+Persistent inverted index of the ICD codes in raw NIS files
+
+Built once per raw file: one entry per non-null dx / proc cell, giving the code,
+whether it's a dx or proc code, its position (1 for DX1 / I10_DX1 / PR1...)
+and the row group / row it came from. Entries are sorted by code, so looking
+up a code set only reads the parts of the index those codes fall in, and the
+first-pass filter can go straight to the matching rows of the raw file
+instead of rescanning it for every new code set.
+"""
+import glob
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+from nisicd import logging
+from nisicd.dataProcessing import get_dx_cols, get_proc_cols
+from nisicd.stageCache import (
+    StageCache,
+    get_versioned_dir,
+    mark_complete,
+    reset_stale_dirs,
+)
+
+
+class CodeIndex:
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    @staticmethod
+    def get_index_dir(fname: str, file_digest: str, index_root: str) -> str:
+        """
+        Indexes only depend on the raw file's contents, not on any code set
+        """
+        return get_versioned_dir(index_root, fname, file_digest)
+
+    @staticmethod
+    def index_row_group(task) -> int:
+        """
+        Write the index entries for a single row group, returning their count
+        """
+        fname, rg_idx, index_dir = task
+        pf = pq.ParquetFile(fname)
+        all_cols = pf.schema_arrow.names
+        kinds = {"dx": get_dx_cols(all_cols), "proc": get_proc_cols(all_cols)}
+        table = pf.read_row_group(rg_idx, columns=kinds["dx"] + kinds["proc"])
+
+        parts = list()
+        for kind, cols in kinds.items():
+            for c in cols:
+                column = table.column(c)
+                valid = column.is_valid().to_numpy(zero_copy_only=False)
+                rows = np.flatnonzero(valid)
+                position = int(re.search("[0-9]+$", c).group())
+
+                parts.append(
+                    pa.table(
+                        {
+                            "code": pc.cast(
+                                column.filter(pa.array(valid)), pa.string()
+                            ),
+                            "kind": pa.array(np.full(len(rows), kind), pa.string()),
+                            "position": pa.array(
+                                np.full(len(rows), position), pa.int16()
+                            ),
+                            "row_group": pa.array(
+                                np.full(len(rows), rg_idx), pa.int32()
+                            ),
+                            "row": pa.array(rows, pa.int32()),
+                        }
+                    )
+                )
+
+        index = pa.concat_tables(parts).sort_by(
+            [("code", "ascending"), ("row", "ascending")]
+        )
+
+        # Sorted by code, so row group statistics on the index prune lookups
+        pq.write_table(
+            index,
+            os.path.join(index_dir, f"rg-{rg_idx:05d}.parquet"),
+            row_group_size=1_000_000,
+        )
+
+        return index.num_rows
+
+    @classmethod
+    def build(
+        cls,
+        fnames: List[str],
+        file_digests: Dict[str, str],
+        index_root: str = "./cache/index",
+        max_workers: int = None,
+    ) -> Dict[str, "CodeIndex"]:
+        """
+        Index any raw files that don't already have a complete index, and
+        return the indexes for all of them
+        """
+        if max_workers is None:
+            max_workers = len(os.sched_getaffinity(0))
+
+        index_dirs = {
+            fname: cls.get_index_dir(fname, file_digests[fname], index_root)
+            for fname in fnames
+        }
+        # Incomplete indexes start over, and indexes of previous versions of
+        # their files are dropped
+        stale_fnames = reset_stale_dirs(index_dirs)
+
+        if len(stale_fnames) > 0:
+            tasks = [
+                (fname, rg_idx, index_dirs[fname])
+                for fname in stale_fnames
+                for rg_idx in range(pq.ParquetFile(fname).num_row_groups)
+            ]
+
+            logging.info(
+                f"Indexing {len(stale_fnames)} files ({len(tasks)} row groups) "
+                f"with {max_workers} processes"
+            )
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                list(tqdm(executor.map(cls.index_row_group, tasks), total=len(tasks)))
+
+            for fname in stale_fnames:
+                mark_complete(index_dirs[fname])
+
+        return {fname: cls(index_dirs[fname]) for fname in fnames}
+
+    def lookup(
+        self, codes: List[str], kind: str, primary_only: bool = False
+    ) -> Dict[int, np.ndarray]:
+        """
+        Sorted rows, per row group, with any of codes as a dx (or proc) code
+        """
+        filters = [("code", "in", list(codes)), ("kind", "=", kind)]
+        if primary_only:
+            filters.append(("position", "=", 1))
+
+        hits = pq.read_table(
+            glob.glob(os.path.join(self.path, "rg-*.parquet")),
+            columns=["row_group", "row"],
+            filters=filters,
+        )
+
+        row_groups = hits.column("row_group").to_numpy()
+        rows = hits.column("row").to_numpy()
+
+        return {
+            int(rg_idx): np.unique(rows[row_groups == rg_idx])
+            for rg_idx in np.unique(row_groups)
+        }
+
+
+if __name__ == "__main__":
+    fnames = glob.glob("data/*.parquet")
+    stage_cache = StageCache("codeIndex", inputs=fnames)
+
+    CodeIndex.build(fnames, {f: stage_cache.file_digest(f) for f in fnames})
+    stage_cache.commit()
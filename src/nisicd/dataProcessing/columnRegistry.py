@@ -0,0 +1,79 @@
+"""
+Registry of the raw NIS columns each stage needs
+
+Stages declare their columns (by name, or by regex pattern for numbered
+columns like DX1..DX40) where they're defined, and the loader reads just the
+union of those, so the cohort never has to be read in full
+"""
+import re
+from typing import List
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from nisicd import logging
+from nisicd.arrowCache import read_cache
+
+
+class ColumnRegistry:
+    def __init__(self) -> None:
+        # stage -> (column names, column patterns)
+        self.requirements = dict()
+
+    def require(self, stage: str, cols: List[str] = [], patterns: List[str] = []):
+        names, pats = self.requirements.setdefault(stage, (list(), list()))
+        names += [c for c in cols if c not in names]
+        pats += [p for p in patterns if p not in pats]
+
+    def projection(self, all_cols, stages: List[str] = None) -> List[str]:
+        """
+        Columns of all_cols needed by the given stages (default: every
+        registered stage), in file order. Named columns that aren't in all_cols
+        are reported together, rather than as a KeyError somewhere downstream
+        """
+        if stages is None:
+            stages = list(self.requirements.keys())
+
+        names, pats = set(), set()
+        for stage in stages:
+            stage_names, stage_pats = self.requirements[stage]
+            names.update(stage_names)
+            pats.update(stage_pats)
+
+        missing = sorted(names.difference(all_cols))
+        if len(missing) > 0:
+            raise ValueError(f"Required columns not found: {missing}")
+
+        return [c for c in all_cols if c in names or any(re.search(p, c) for p in pats)]
+
+    def read_parquet(self, path: str, stages: List[str] = None) -> pd.DataFrame:
+        all_cols = pq.read_schema(path).names
+        used_cols = self.projection(all_cols, stages=stages)
+
+        logging.info(f"Reading {len(used_cols)} of {len(all_cols)} columns of {path}")
+        return read_cache(path, columns=used_cols)
+
+
+def iter_parquet(path: str, columns: List[str] = None, chunk_size: int = None):
+    """
+    DataFrames of a parquet file, either the whole file at once or (if
+    chunk_size is set) at most chunk_size rows at a time. Either way there's
+    at least one frame, so an empty file gives a single empty frame
+    """
+    if chunk_size is None:
+        yield read_cache(path, columns=columns)
+        return
+
+    pf = pq.ParquetFile(path)
+    if pf.metadata.num_rows == 0:
+        empty = pf.schema_arrow.empty_table()
+        yield (empty if columns is None else empty.select(columns)).to_pandas()
+        return
+
+    for batch in pf.iter_batches(
+        batch_size=chunk_size, columns=columns, use_pandas_metadata=True
+    ):
+        yield batch.to_pandas()
+
+
+column_registry = ColumnRegistry()
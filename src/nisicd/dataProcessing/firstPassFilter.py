@@ -1,10 +1,23 @@
 """
 First-pass filter to isolate thyroidectomies from RAW NIS data
 """
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import glob
 from nisicd import logging
+from nisicd.arrowCache import write_arrow_copy
 from nisicd.dataProcessing import DX_CODES
+from nisicd.dataProcessing.codeIndex import CodeIndex
+from nisicd.dataProcessing.icdMatcher import IcdMatcher
+from nisicd.stageCache import (
+    StageCache,
+    get_versioned_dir,
+    hash_params,
+    mark_complete,
+    reset_stale_dirs,
+)
 from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 import re
@@ -13,13 +26,28 @@ import os
 
 class ParallelFilter:
     def __init__(
-        self, dx_codes=[], dx_as_primary=False, proc_codes=[], proc_as_primary=False
+        self,
+        dx_codes=[],
+        dx_as_primary=False,
+        proc_codes=[],
+        proc_as_primary=False,
+        batch_size=None,
+        index_root=None,
     ) -> None:
         logging.info("Initializing parallel filter...")
         self.dx_codes = dx_codes
         self.proc_codes = proc_codes
         self.dx_as_primary = dx_as_primary
         self.proc_as_primary = proc_as_primary
+        # If set, matching row groups are read in batches of at most this many
+        # rows rather than all at once, bounding peak memory per worker
+        self.batch_size = batch_size
+        # If set, matching rows are looked up in per-file code indexes (built
+        # under this directory on first use) rather than found by scanning
+        self.index_root = index_root
+
+        self.dx_matcher = IcdMatcher.from_codes(exact=dx_codes)
+        self.proc_matcher = IcdMatcher.from_codes(exact=proc_codes)
 
         self.cores_available = len(os.sched_getaffinity(0))
 
@@ -45,51 +73,347 @@ class ParallelFilter:
 
         return icd9_cols + icd10_cols
 
-    def __find_in_cols(self, df, cols, vals):
-        return df[df[cols].isin(vals).any(axis="columns")]
+    def _get_predicate_cols(self, all_cols):
+        """
+        The dx / proc columns the code predicate is evaluated on. An empty list
+        means that side of the predicate is not applied
+        """
+        dx_cols, proc_cols = list(), list()
+
+        if len(self.dx_codes) > 0:
+            dx_cols = self.get_dx_cols(all_cols)
 
-    def _get_relevant_dx(self, df):
+            if self.dx_as_primary:
+                dx_cols = [c for c in dx_cols if c in ["DX1", "I10_DX1"]]
 
-        if len(self.dx_codes) == 0:
-            return df
+        if len(self.proc_codes) > 0:
+            proc_cols = self.get_proc_cols(all_cols)
 
-        dx_cols = self.get_dx_cols(df.columns)
+            if self.proc_as_primary:
+                proc_cols = [c for c in proc_cols if c in ["PR1", "I10_PR1"]]
 
-        if self.dx_as_primary:
-            dx_cols = [c for c in dx_cols if c in ["DX1", "I10_DX1"]]
+        return dx_cols, proc_cols
 
-        return self.__find_in_cols(df, dx_cols, self.dx_codes)
+    def _get_match_mask(self, data, dx_cols, proc_cols) -> np.ndarray:
+        """
+        Row mask for a DataFrame or Arrow table holding (at least) the predicate cols
+        """
+        mask = np.ones(len(data), dtype=bool)
 
-    def _get_relevant_proc(self, df):
-        if len(self.proc_codes) == 0:
-            return df
+        if len(self.dx_codes) > 0:
+            mask &= self.dx_matcher.any(data, dx_cols)
 
-        proc_cols = self.get_proc_cols(df.columns)
+        if len(self.proc_codes) > 0:
+            mask &= self.proc_matcher.any(data, proc_cols)
 
-        if self.proc_as_primary:
-            proc_cols = [c for c in proc_cols if c in ["PR1", "I10_PR1"]]
+        return mask
 
-        return self.__find_in_cols(df, proc_cols, self.proc_codes)
+    @staticmethod
+    def _cols_may_match(rg_meta, col_positions, cols, matcher) -> bool:
+        """
+        Use row group min / max statistics to decide whether any of the cols
+        could contain a matching code
+        """
+        for c in cols:
+            stats = rg_meta.column(col_positions[c]).statistics
 
-    def single_file_filter(self, fname):
-        df = pd.read_parquet(fname)
-        relevant = self._get_relevant_dx(df)
-        relevant = self._get_relevant_proc(relevant)
-        return relevant
+            if stats is None:
+                return True
+            elif stats.num_values == 0:
+                # Column is entirely null in this row group
+                continue
+            elif not stats.has_min_max:
+                return True
+            elif matcher.may_match_range(str(stats.min), str(stats.max)):
+                return True
 
-    def parallel_file_filter(self, fnames):
-        logging.info(f"Running filter with {self.cores_available} processes")
-        with ProcessPoolExecutor(max_workers=self.cores_available) as executor:
-            res = list(
-                tqdm(executor.map(self.single_file_filter, fnames), total=len(fnames))
+        return False
+
+    def _row_group_may_match(self, rg_meta, col_positions, dx_cols, proc_cols):
+        if len(self.dx_codes) > 0 and not self._cols_may_match(
+            rg_meta, col_positions, dx_cols, self.dx_matcher
+        ):
+            return False
+
+        if len(self.proc_codes) > 0 and not self._cols_may_match(
+            rg_meta, col_positions, proc_cols, self.proc_matcher
+        ):
+            return False
+
+        return True
+
+    def _iter_row_group_matches(
+        self, pf, rg_idx, col_positions, dx_cols, proc_cols, rows=None
+    ):
+        """
+        Two-phase read of a single row group: rule it out from its statistics
+        if possible, otherwise evaluate the predicate on just the dx / proc
+        columns and only then read full rows (all at once, or in batches)
+
+        If the matching rows are already known (from a code index), they're
+        read directly
+        """
+        if rows is not None:
+            mask = np.zeros(pf.metadata.row_group(rg_idx).num_rows, dtype=bool)
+            mask[rows] = True
+        elif not self._row_group_may_match(
+            pf.metadata.row_group(rg_idx), col_positions, dx_cols, proc_cols
+        ):
+            return
+        else:
+            predicate_cols = list(dict.fromkeys(dx_cols + proc_cols))
+            codes = pf.read_row_group(rg_idx, columns=predicate_cols)
+            mask = self._get_match_mask(codes, dx_cols, proc_cols)
+
+        if not mask.any():
+            return
+
+        if self.batch_size is None:
+            yield pf.read_row_group(rg_idx).filter(pa.array(mask))
+            return
+
+        offset = 0
+        for batch in pf.iter_batches(
+            batch_size=self.batch_size, row_groups=[rg_idx], use_pandas_metadata=True
+        ):
+            batch_mask = mask[offset : offset + batch.num_rows]
+            offset += batch.num_rows
+
+            if batch_mask.any():
+                yield pa.Table.from_batches([batch.filter(pa.array(batch_mask))])
+
+    def iter_file_filter(self, fname, row_groups=None, indexed_rows=None):
+        """
+        Stream matching rows of a single file as DataFrames, one per matching
+        row group (or per batch if batch_size is set)
+
+        indexed_rows optionally gives the matching rows of each row group up
+        front (see get_indexed_rows)
+        """
+        pf = pq.ParquetFile(fname)
+        dx_cols, proc_cols = self._get_predicate_cols(pf.schema_arrow.names)
+
+        col_positions = {
+            pf.metadata.schema.column(idx).path: idx
+            for idx in range(pf.metadata.num_columns)
+        }
+
+        if row_groups is None:
+            row_groups = range(pf.num_row_groups)
+
+        for rg_idx in row_groups:
+            rows = None
+            if indexed_rows is not None:
+                rows = indexed_rows.get(rg_idx, np.array([], dtype=int))
+
+            for matched in self._iter_row_group_matches(
+                pf, rg_idx, col_positions, dx_cols, proc_cols, rows=rows
+            ):
+                yield matched.to_pandas()
+
+    def single_file_filter(self, fname, row_groups=None, indexed_rows=None):
+        matched = list(
+            self.iter_file_filter(
+                fname, row_groups=row_groups, indexed_rows=indexed_rows
             )
+        )
+
+        if len(matched) == 0:
+            return pq.ParquetFile(fname).schema_arrow.empty_table().to_pandas()
+
+        return pd.concat(matched)
+
+    def row_group_filter(self, task):
+        """
+        Filter a single row group and write the matches straight to a parquet
+        partition, so that only the partition path and row count go back to
+        the parent process
+        """
+        fname, rg_idx, partition_dir, rows = task
+        filtered_df = self.single_file_filter(
+            fname,
+            row_groups=[rg_idx],
+            indexed_rows=None if rows is None else {rg_idx: rows},
+        )
 
-        filtered_df = pd.concat(res)
         # Pyarrow (parquet) complains if this column is dealt with
-        filtered_df.HOSPSTCO = filtered_df.HOSPSTCO.astype("str")
-        filtered_df.to_parquet("./cache/appendicitis.parquet", index=False)
+        if "HOSPSTCO" in filtered_df.columns:
+            filtered_df.HOSPSTCO = filtered_df.HOSPSTCO.astype("str")
+
+        # Partitions are written even when empty so that every file's columns
+        # make it into the merged schema
+        partition_path = os.path.join(partition_dir, f"rg-{rg_idx:05d}.parquet")
+        filtered_df.to_parquet(partition_path, index=False)
+
+        return partition_path, len(filtered_df)
+
+    def get_indexed_rows(self, code_index: CodeIndex):
+        """
+        Matching rows per row group, from a file's code index. Rows have to
+        match on both dx and proc codes if both are given
+        """
+        lookups = list()
+
+        if len(self.dx_codes) > 0:
+            lookups.append(code_index.lookup(self.dx_codes, "dx", self.dx_as_primary))
+
+        if len(self.proc_codes) > 0:
+            lookups.append(
+                code_index.lookup(self.proc_codes, "proc", self.proc_as_primary)
+            )
+
+        if len(lookups) == 0:
+            # No predicate, every row matches
+            return None
+
+        indexed_rows = lookups[0]
+        for other in lookups[1:]:
+            indexed_rows = {
+                rg_idx: np.intersect1d(rows, other[rg_idx])
+                for rg_idx, rows in indexed_rows.items()
+                if rg_idx in other
+            }
+
+        return indexed_rows
+
+    @staticmethod
+    def get_row_group_tasks(fnames, partition_dirs, indexed_rows=None):
+        """
+        Work is scheduled per row group so that one large year doesn't leave
+        the rest of the pool idle
+        """
+        tasks = list()
+
+        for fname in fnames:
+            file_rows = None if indexed_rows is None else indexed_rows[fname]
+
+            for rg_idx in range(pq.ParquetFile(fname).num_row_groups):
+                rows = None
+                if file_rows is not None:
+                    rows = file_rows.get(rg_idx, np.array([], dtype=int))
+
+                tasks.append((fname, rg_idx, partition_dirs[fname], rows))
+
+        return tasks
+
+    def get_params(self) -> dict:
+        """
+        Everything that affects which rows come out of the filter
+        """
+        return {
+            "dx_codes": self.dx_codes,
+            "dx_as_primary": self.dx_as_primary,
+            "proc_codes": self.proc_codes,
+            "proc_as_primary": self.proc_as_primary,
+        }
+
+    def get_partition_dir(self, fname, file_digest, cache_dir, source_digests):
+        """
+        Per-file results are content-addressed by the raw file, the filter
+        params and the filter's source, so only raw files that changed (or new
+        code sets / matching logic) get rescanned
+        """
+        key = hash_params(
+            {
+                "file": file_digest,
+                "params": self.get_params(),
+                "sources": source_digests,
+            }
+        )
+        return get_versioned_dir(cache_dir, fname, key)
+
+    @staticmethod
+    def merge_partitions(partition_paths, out_path):
+        """
+        Stream partitions into a single parquet file one at a time, without
+        ever materializing the concatenated DataFrame. Years don't all share the
+        same columns, so partitions are conformed to the unified schema (columns
+        a partition lacks are filled with nulls)
+        """
+        schema = pa.unify_schemas(
+            [pq.read_schema(p).remove_metadata() for p in partition_paths],
+            promote_options="permissive",
+        )
+
+        with pq.ParquetWriter(out_path, schema) as writer:
+            for p in partition_paths:
+                table = pq.read_table(p)
+                columns = [
+                    table.column(field.name).cast(field.type)
+                    if field.name in table.column_names
+                    else pa.nulls(table.num_rows, type=field.type)
+                    for field in schema
+                ]
+                writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+
+    def parallel_file_filter(
+        self,
+        fnames,
+        out_path="./cache/appendicitis.parquet",
+        cache_dir="./cache/firstpass",
+    ):
+        stage_cache = StageCache(
+            "firstPassFilter",
+            inputs=fnames,
+            outputs=[out_path],
+            params=self.get_params(),
+        )
+
+        if stage_cache.is_fresh():
+            logging.info(f"[*] {stage_cache.stage} is up to date, skipping")
+            return
+
+        partition_dirs = {
+            fname: self.get_partition_dir(
+                fname,
+                stage_cache.file_digest(fname),
+                cache_dir,
+                stage_cache.source_digests,
+            )
+            for fname in fnames
+        }
+        # Incomplete partitions start over, and partitions from previous
+        # versions of their files / code sets are dropped
+        stale_fnames = reset_stale_dirs(partition_dirs)
+
+        indexed_rows = None
+        has_predicate = len(self.dx_codes) + len(self.proc_codes) > 0
+        if self.index_root is not None and has_predicate and len(stale_fnames) > 0:
+            code_indexes = CodeIndex.build(
+                stale_fnames,
+                {f: stage_cache.file_digest(f) for f in stale_fnames},
+                index_root=self.index_root,
+                max_workers=self.cores_available,
+            )
+            indexed_rows = {
+                f: self.get_indexed_rows(code_indexes[f]) for f in stale_fnames
+            }
+
+        tasks = self.get_row_group_tasks(stale_fnames, partition_dirs, indexed_rows)
+
+        logging.info(
+            f"Running filter with {self.cores_available} processes "
+            f"over {len(tasks)} row groups in {len(stale_fnames)} files "
+            f"({len(fnames) - len(stale_fnames)} files cached)"
+        )
+        with ProcessPoolExecutor(max_workers=self.cores_available) as executor:
+            list(tqdm(executor.map(self.row_group_filter, tasks), total=len(tasks)))
+
+        for fname in stale_fnames:
+            mark_complete(partition_dirs[fname])
+
+        partition_paths = list()
+        for fname in fnames:
+            partition_paths += sorted(
+                glob.glob(os.path.join(partition_dirs[fname], "rg-*.parquet"))
+            )
+
+        self.merge_partitions(partition_paths, out_path)
+        write_arrow_copy(out_path)
+        stage_cache.commit()
 
-        logging.info(f"[+] Parallel filter done final count: {len(filtered_df)}")
+        final_count = pq.ParquetFile(out_path).metadata.num_rows
+        logging.info(f"[+] Parallel filter done final count: {final_count}")
 
 
 if __name__ == "__main__":
@@ -98,7 +422,12 @@ if __name__ == "__main__":
     for key, val in DX_CODES.items():
         dx_codes += val
 
-    parallel_filter = ParallelFilter(dx_codes=dx_codes, dx_as_primary=True)
+    parallel_filter = ParallelFilter(
+        dx_codes=dx_codes,
+        dx_as_primary=True,
+        batch_size=100_000,
+        index_root="./cache/index",
+    )
     fnames = glob.glob("data/*.parquet")
 
     parallel_filter.parallel_file_filter(fnames)
@@ -0,0 +1,147 @@
+"""
+Compiled ICD code matcher shared by the first-pass filter, SSI flags and CCI
+
+Code sets are compiled once into hash lookups (exact codes and code prefixes),
+so resolving a single code costs O(code length) regardless of how many codes
+are in the set. Data is factorized across all requested columns first, which
+means every distinct code in the data is only resolved once.
+"""
+from bisect import bisect_left
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+
+class IcdMatcher:
+    def __init__(
+        self,
+        exact_codes: Dict[str, List[str]] = None,
+        prefix_codes: Dict[str, List[str]] = None,
+    ) -> None:
+        exact_codes = exact_codes or dict()
+        prefix_codes = prefix_codes or dict()
+
+        # Category order is insertion order: exact code keys first, then any
+        # categories that only have prefix codes
+        self.labels = list(exact_codes.keys())
+        self.labels += [k for k in prefix_codes.keys() if k not in exact_codes]
+
+        self.exact_lookup = dict()
+        self.prefix_lookup = dict()
+
+        for category_idx, label in enumerate(self.labels):
+            for code in exact_codes.get(label, []):
+                self.exact_lookup.setdefault(code, set()).add(category_idx)
+
+            for code in prefix_codes.get(label, []):
+                self.prefix_lookup.setdefault(code, set()).add(category_idx)
+
+        self.max_prefix_len = max((len(p) for p in self.prefix_lookup), default=0)
+        self.sorted_exact = sorted(self.exact_lookup.keys())
+
+    @classmethod
+    def from_codes(cls, exact: List[str] = [], prefix: List[str] = []):
+        """
+        Single-category matcher, for when only "does anything match" matters
+        """
+        return cls(
+            exact_codes={"match": list(exact)}, prefix_codes={"match": list(prefix)}
+        )
+
+    def resolve(self, code: str) -> set:
+        """
+        Indices of all categories hit by a single code
+        """
+        categories = set(self.exact_lookup.get(code, ()))
+
+        for prefix_len in range(1, min(len(code), self.max_prefix_len) + 1):
+            categories.update(self.prefix_lookup.get(code[:prefix_len], ()))
+
+        return categories
+
+    def may_match_range(self, lo: str, hi: str) -> bool:
+        """
+        Could any code in the closed interval [lo, hi] hit a category? Used to
+        rule out whole parquet row groups from their min / max statistics
+        """
+        exact_idx = bisect_left(self.sorted_exact, lo)
+        if exact_idx < len(self.sorted_exact) and self.sorted_exact[exact_idx] <= hi:
+            return True
+
+        # Codes starting with p form the interval [p, p + <anything>], which
+        # overlaps [lo, hi] iff p <= hi and lo doesn't sort past every p-prefixed code
+        return any(p <= hi and lo[: len(p)] <= p for p in self.prefix_lookup)
+
+    def _resolve_uniques(self, uniques) -> np.ndarray:
+        """
+        Boolean (n_uniques + 1, n_categories) hit table. The trailing all-False
+        row is what missing cells (id -1) index into
+        """
+        hit_table = np.zeros((len(uniques) + 1, len(self.labels)), dtype=bool)
+
+        for unique_idx, code in enumerate(uniques):
+            for category_idx in self.resolve(str(code)):
+                hit_table[unique_idx, category_idx] = True
+
+        return hit_table
+
+    @staticmethod
+    def _factorize(data, cols: List[str]):
+        """
+        Factorize every cell of the requested columns together
+
+        Returns an (n_rows, n_cols) array of ids into the returned uniques, with
+        -1 for missing cells. Accepts either a pandas DataFrame or a pyarrow Table
+        """
+        if isinstance(data, pd.DataFrame):
+            n_rows = len(data)
+            cells = data[cols].to_numpy(dtype=object).T.ravel()
+            ids, uniques = pd.factorize(cells)
+        else:
+            import pyarrow as pa
+            import pyarrow.compute as pc
+
+            n_rows = data.num_rows
+            cells = pa.chunked_array(
+                [
+                    chunk
+                    for c in cols
+                    for chunk in data.column(c).cast(pa.string()).chunks
+                ],
+                type=pa.string(),
+            )
+            uniques = pc.unique(cells).drop_null()
+            ids = pc.index_in(cells, value_set=uniques).fill_null(-1)
+            ids = ids.to_numpy()
+            uniques = uniques.to_pylist()
+
+        return ids.reshape(len(cols), n_rows).T, uniques
+
+    def hits(self, data, cols: List[str]) -> np.ndarray:
+        """
+        Boolean (n_rows, n_categories) matrix: does any column hit the category
+        """
+        return self.counts(data, cols) > 0
+
+    def counts(self, data, cols: List[str]) -> np.ndarray:
+        """
+        Integer (n_rows, n_categories) matrix: how many columns hit the category
+        """
+        ids, uniques = self._factorize(data, cols)
+        hit_table = self._resolve_uniques(uniques).astype(np.int32)
+
+        counts = np.zeros((ids.shape[0], len(self.labels)), dtype=np.int32)
+        for col_idx in range(ids.shape[1]):
+            counts += hit_table[ids[:, col_idx]]
+
+        return counts
+
+    def any(self, data, cols: List[str]) -> np.ndarray:
+        """
+        Boolean row mask: does any column hit any category
+        """
+        ids, uniques = self._factorize(data, cols)
+        unique_hits = self._resolve_uniques(uniques).any(axis=1)
+
+        return unique_hits[ids].any(axis=1)
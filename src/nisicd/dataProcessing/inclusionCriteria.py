@@ -4,105 +4,179 @@ Apply study inclusion criteria:
 - Diagnosis codes of interest
 - Procedure codes of interest
 """
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 from nisicd import logging
-from nisicd.dataProcessing import get_dx_cols
+from nisicd.arrowCache import write_arrow_copy
+from nisicd.dataProcessing import chunk_size
+from nisicd.dataProcessing.columnRegistry import column_registry
+from nisicd.stageCache import StageCache
 
 
 class InclusionCriteria:
+    # Criteria are applied in this order, which is the order attrition is
+    # reported in (e.g. for the CONSORT diagram)
+    rule_order = ["dropna", "age", "tranout", "aprdrgs"]
+
+    # We can handle FEMALE and RACE missing, but need other columns
+    non_null_cols = [
+        "AGE",
+        "PAY1",
+        "APRDRG_Severity",
+        "APRDRG_Risk_Mortality",
+        "HOSP_LOCTEACH",
+        # "HOSP_DIVISION",
+        "HOSP_REGION",
+        "DIED",
+        "LOS",
+    ]
+    required_cols = non_null_cols + ["ZIPINC", "ZIPINC_QRTL", "TRAN_OUT"]
+
     def __init__(self, base_df) -> None:
         self.base_df = base_df
+        self.attrition = None
         logging.info(
             f"Inclusion criteria filter instantiated with n={len(self.base_df)}"
         )
 
-    @staticmethod
-    def _ic_dropna(df_in: pd.DataFrame) -> pd.DataFrame:
-        # We can handle FEMALE and RACE missing, but need other columns
-        cols = [
-            "AGE",
-            "PAY1",
-            "APRDRG_Severity",
-            "APRDRG_Risk_Mortality",
-            "HOSP_LOCTEACH",
-            # "HOSP_DIVISION",
-            "HOSP_REGION",
-            "DIED",
-            "LOS",
-        ]
-
-        df_in = df_in.dropna(subset=cols, how="any")
+    @classmethod
+    def _ic_dropna(cls, df_in: pd.DataFrame) -> pd.Series:
+        mask = df_in[cls.non_null_cols].notna().all(axis=1)
 
         # Can have either ZIPINC OR ZIPINC_QRTL
-        df_in = df_in.dropna(subset=["ZIPINC", "ZIPINC_QRTL"], how="all")
+        mask &= df_in[["ZIPINC", "ZIPINC_QRTL"]].notna().any(axis=1)
 
-        return df_in
+        return mask
 
     @staticmethod
-    def _ic_age(df_in: pd.DataFrame) -> pd.DataFrame:
-        df_in = df_in[df_in["AGE"] < 65]
-        df_in = df_in[df_in["AGE"] > 18]
-        return df_in
+    def _ic_age(df_in: pd.DataFrame) -> pd.Series:
+        return (df_in["AGE"] < 65) & (df_in["AGE"] > 18)
 
     @staticmethod
-    def _ic_tranout(df_in: pd.DataFrame) -> pd.DataFrame:
-        return df_in[df_in["TRAN_OUT"] == 0]
+    def _ic_tranout(df_in: pd.DataFrame) -> pd.Series:
+        return df_in["TRAN_OUT"] == 0
 
     @staticmethod
-    def _ic_aprdrgs(df_in: pd.DataFrame) -> pd.DataFrame:
-        return df_in[
-            (df_in["APRDRG_Severity"] > 0) & (df_in["APRDRG_Risk_Mortality"] > 0)
-        ]
-
-    def apply_ic(self) -> pd.DataFrame:
-        ic_methods = [m for m in dir(self) if m.startswith("_ic")]
-        df = self.base_df
-
-        for method_name in ic_methods:
-            before_count = len(df)
-            func = getattr(self, method_name)
-            df = func(df)
-            after_count = len(df)
+    def _ic_aprdrgs(df_in: pd.DataFrame) -> pd.Series:
+        return (df_in["APRDRG_Severity"] > 0) & (df_in["APRDRG_Risk_Mortality"] > 0)
+
+    @classmethod
+    def cumulative_masks(cls, df_in: pd.DataFrame):
+        """
+        Every criterion is evaluated on the same (unfiltered) frame. Yields each
+        rule with the mask of rows passing it and every rule before it
+        """
+        mask = np.ones(len(df_in), dtype=bool)
+
+        for rule in cls.rule_order:
+            mask = mask & getattr(cls, f"_ic_{rule}")(df_in).to_numpy(dtype=bool)
+            yield rule, mask
+
+    @classmethod
+    def get_attrition(cls, base_count: int, remaining_counts) -> pd.DataFrame:
+        attrition = list()
+        before_count = base_count
+
+        for rule, after_count in zip(cls.rule_order, remaining_counts):
             logging.info(
-                f"{method_name} diff: {before_count - after_count} ({before_count} -> {after_count})"
+                f"_ic_{rule} diff: {before_count - after_count} ({before_count} -> {after_count})"
+            )
+            attrition.append(
+                {
+                    "rule": rule,
+                    "excluded": before_count - after_count,
+                    "remaining": after_count,
+                }
             )
+            before_count = after_count
+
+        return pd.DataFrame(attrition)
+
+    def get_mask(self) -> np.ndarray:
+        """
+        Combined mask over all rules. Attrition after each rule comes from the
+        cumulative masks, so no intermediate frames are materialized
+        """
+        remaining_counts = list()
+
+        for rule, mask in self.cumulative_masks(self.base_df):
+            remaining_counts.append(int(mask.sum()))
+
+        self.attrition = self.get_attrition(len(self.base_df), remaining_counts)
+        return mask
+
+    def apply_ic(self) -> pd.DataFrame:
+        df = self.base_df[self.get_mask()]
 
         logging.info(f"Success, final size: {len(df)}")
         return df
 
+    @classmethod
+    def apply_ic_chunked(
+        cls, path: str, out_path: str, columns, chunk_size: int
+    ) -> pd.DataFrame:
+        """
+        Out-of-core apply_ic: stream path chunk_size rows at a time, writing the
+        rows that pass straight to out_path. Returns the attrition table
+        """
+        pf = pq.ParquetFile(path)
+        schema = pa.schema([pf.schema_arrow.field(c) for c in columns])
+        base_count = 0
+        remaining_counts = np.zeros(len(cls.rule_order), dtype=int)
+
+        with pq.ParquetWriter(out_path, schema) as writer:
+            for batch in pf.iter_batches(batch_size=chunk_size, columns=columns):
+                for idx, (rule, mask) in enumerate(
+                    cls.cumulative_masks(batch.to_pandas())
+                ):
+                    remaining_counts[idx] += mask.sum()
+
+                base_count += batch.num_rows
+                writer.write_batch(batch.filter(pa.array(mask)))
+
+        logging.info(f"Inclusion criteria streamed over n={base_count}")
+        attrition = cls.get_attrition(base_count, remaining_counts.tolist())
+
+        logging.info(f"Success, final size: {remaining_counts[-1]}")
+        return attrition
+
+
+column_registry.require("inclusionCriteria", cols=InclusionCriteria.required_cols)
+
 
 if __name__ == "__main__":
-    # Have to cut down on number of cols or run out of mem
-    all_cols = pd.read_parquet("cache/appendicitis.parquet").columns
-    dx_cols = get_dx_cols(all_cols)
-    cm_cols = [c for c in all_cols if c.startswith("CM_")]
-    cm_cols += [c for c in all_cols if c.startswith("CMR_")]
-
-    used_cols = (
-        [
-            "AGE",
-            "FEMALE",
-            "RACE",
-            "PAY1",
-            "APRDRG_Severity",
-            "APRDRG_Risk_Mortality",
-            "HOSP_LOCTEACH",
-            # "HOSP_DIVISION",
-            "HOSP_REGION",
-            "DIED",
-            "LOS",
-            "ZIPINC",
-            "ZIPINC_QRTL",
-            "TRAN_OUT",
-            "I10_NPR",
-            "NPR",
-            "YEAR",
-        ]
-        + dx_cols
-        + cm_cols
+    stage_cache = StageCache(
+        "inclusionCriteria",
+        inputs=["cache/appendicitis.parquet", __file__],
+        outputs=["cache/filtered.parquet", "cache/attrition.csv"],
+        params={"columns": column_registry.requirements},
     )
-    df = pd.read_parquet("cache/appendicitis.parquet", columns=used_cols)
-    ic = InclusionCriteria(df)
-    filtered = ic.apply_ic()
-    filtered.to_parquet("cache/filtered.parquet")
+    stage_cache.skip_if_fresh()
+
+    # Only read the columns this and later stages need, or run out of mem
+    used_stages = ["inclusionCriteria", "process", "composite_comorbidities", "dx_cols"]
+
+    if chunk_size is None:
+        df = column_registry.read_parquet(
+            "cache/appendicitis.parquet", stages=used_stages
+        )
+        ic = InclusionCriteria(df)
+        filtered = ic.apply_ic()
+        filtered.to_parquet("cache/filtered.parquet")
+        attrition = ic.attrition
+    else:
+        attrition = InclusionCriteria.apply_ic_chunked(
+            "cache/appendicitis.parquet",
+            "cache/filtered.parquet",
+            column_registry.projection(
+                pq.read_schema("cache/appendicitis.parquet").names, stages=used_stages
+            ),
+            chunk_size,
+        )
+
+    write_arrow_copy("cache/filtered.parquet")
+    attrition.to_csv("cache/attrition.csv", index=False)
+    stage_cache.commit()
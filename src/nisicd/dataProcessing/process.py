@@ -1,131 +1,303 @@
 """
 Prepare raw (filtered) NIS data for use in models
 """
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from nisicd import logging
+from nisicd.arrowCache import write_arrow_copy
 from nisicd.dataProcessing import (
     get_dx_cols,
     categorical_lookup,
     ssi_codes,
     composite_comorbidities,
+    process_copy_cols,
     DX_CODES,
+    prolonged_los_quantile,
+    chunk_size,
 )
 import json
-from nisicd.cci import CCI
+from nisicd.dataProcessing.columnRegistry import iter_parquet
+from nisicd.dataProcessing.icdMatcher import IcdMatcher
+from nisicd.cci import CCI, get_cci_scores
+from nisicd.stageCache import StageCache
 
+# Raw CMR_* / CM_* columns the composite comorbidities are built from
+composite_cols = list(
+    dict.fromkeys(c for cols in composite_comorbidities.values() for c in cols)
+)
 
-def get_cci_score(codes):
-    score = 0
 
-    # drop empty columns
-    codes_revised = [c for c in codes if c is not None]
+def get_presenting_dx(df: pd.DataFrame) -> pd.Series:
+    """
+    Presenting condition for each row, from the primary dx (I10_DX1, falling
+    back to DX1 where that's empty). Rows that can't be mapped are reported
+    together rather than failing on the first one
+    """
+    primary_dx = pd.Series(None, index=df.index, dtype=object)
 
-    for code in codes_revised:
-        for cci_category, cci_data in CCI.items():
-            match_codes = cci_data["Match Codes"]
-            startswith_codes = cci_data["Startswith Codes"]
+    for col in ["I10_DX1", "DX1"]:
+        if col in df.columns:
+            primary_dx = primary_dx.fillna(df[col].where(df[col] != ""))
 
-            if code in match_codes:
-                score += cci_data["Points"]
+    if primary_dx.isna().any():
+        missing_idx = primary_dx.index[primary_dx.isna()].to_list()
+        raise ValueError(f"No initial Dx for rows: {missing_idx}")
 
-            elif any(code.startswith(swcode) for swcode in startswith_codes):
-                score += cci_data["Points"]
+    # First matching condition wins, same as iterating over DX_CODES in order
+    code_to_condition = dict()
+    for key, val in DX_CODES.items():
+        for code in val:
+            code_to_condition.setdefault(code, key)
 
-    return score
+    condition = primary_dx.map(code_to_condition)
 
+    if condition.isna().any():
+        unmatched = primary_dx[condition.isna()]
+        raise ValueError(
+            f"Couldn't find dx {sorted(unmatched.unique())} "
+            f"for rows: {unmatched.index.to_list()}"
+        )
 
-if __name__ == "__main__":
-    df_in = pd.read_parquet("cache/filtered.parquet")
+    return condition
 
-    df_out = pd.DataFrame()
 
-    copy_cols = [
-        "AGE",
-        "APRDRG_Severity",
-        "APRDRG_Risk_Mortality",
-        "DIED",
-        "PAY1",
-        "RACE",
-        "FEMALE",
-        "HOSP_LOCTEACH",
-        "HOSP_REGION",
-    ]
+def get_prolonged_los(
+    condition: pd.Series, los: pd.Series, thresholds: dict
+) -> pd.Series:
+    """
+    1 if LOS is above the threshold for the presenting condition, else 0
+    """
+    threshold = condition.map(thresholds)
+
+    if threshold.isna().any():
+        invalid = condition[threshold.isna()]
+        raise ValueError(
+            f"Invalid condition {sorted(invalid.unique())} "
+            f"for rows: {invalid.index.to_list()}"
+        )
+
+    return (los > threshold).astype(int)
+
+
+def get_los_thresholds(condition: pd.Series, los: pd.Series, q: float) -> dict:
+    """
+    Per-condition LOS quantile, in a single groupby pass
+    """
+    return los.groupby(condition).quantile(q).to_dict()
+
+
+class LosQuantileSketch:
+    """
+    Mergeable per-condition LOS histogram, for computing the same thresholds as
+    get_los_thresholds when the cohort has to be streamed in chunks
+
+    LOS is binned to `resolution` days. NIS LOS is whole days, so with the
+    default resolution the quantiles are exact (same linear interpolation as
+    pandas), not approximate
+    """
+
+    def __init__(self, resolution: float = 1.0) -> None:
+        self.resolution = resolution
+        # (condition, binned LOS) -> count
+        self.counts = None
+
+    def update(self, condition: pd.Series, los: pd.Series) -> None:
+        binned = (los / self.resolution).round() * self.resolution
+        chunk_counts = binned.groupby([condition.to_numpy(), binned.to_numpy()]).size()
+        self._add_counts(chunk_counts)
+
+    def merge(self, other: "LosQuantileSketch") -> None:
+        if other.counts is not None:
+            self._add_counts(other.counts)
+
+    def _add_counts(self, counts: pd.Series) -> None:
+        if self.counts is None:
+            self.counts = counts.astype(float)
+        else:
+            self.counts = self.counts.add(counts, fill_value=0)
+
+    def quantiles(self, q: float) -> dict:
+        thresholds = dict()
+
+        if self.counts is None:
+            return thresholds
+
+        for condition, counts in self.counts.groupby(level=0):
+            values = counts.index.get_level_values(1).to_numpy()
+            order = np.argsort(values)
+            values = values[order]
+            cumulative = np.cumsum(counts.to_numpy()[order])
+
+            # Position of the quantile among the sorted observations, and the
+            # observations either side of it
+            h = (cumulative[-1] - 1) * q
+            lo, hi = np.floor(h), min(np.floor(h) + 1, cumulative[-1] - 1)
+            lo_value = values[np.searchsorted(cumulative, lo, side="right")]
+            hi_value = values[np.searchsorted(cumulative, hi, side="right")]
+
+            thresholds[condition] = float(lo_value + (h - lo) * (hi_value - lo_value))
+
+        return thresholds
+
+
+def save_los_thresholds(thresholds: dict, q: float, path: str) -> None:
+    with open(path, "w") as f:
+        json.dump({"quantile": q, "thresholds": thresholds}, f, indent=2)
+
+
+def process_chunk(df_in: pd.DataFrame, los_thresholds: dict) -> pd.DataFrame:
+    """
+    Derive processed rows from filtered rows. Each row only depends on itself
+    (and the cohort-wide LOS thresholds), so this works the same on the whole
+    cohort or on any chunk of it
+    """
+    df_out = pd.DataFrame()
 
     # FEMALE, RACE may have NAs
     df_in["FEMALE"] = df_in["FEMALE"].fillna(2)
     df_in["RACE"] = df_in["RACE"].fillna(7)
 
-    for cc in copy_cols:
+    for cc in process_copy_cols:
         df_out[cc] = df_in[cc].astype(int)
 
+    # Small-range codes and flags don't need 64 bits
+    for cc in ["AGE", "APRDRG_Severity", "APRDRG_Risk_Mortality", "DIED"]:
+        df_out[cc] = df_out[cc].astype("int8")
+
     df_out["INCOME_QRTL"] = df_in["ZIPINC_QRTL"].fillna(df_in["ZIPINC"])
     assert not df_out["INCOME_QRTL"].isna().any()
-    df_out["INCOME_QRTL"] = df_out["INCOME_QRTL"].astype(int)
+    df_out["INCOME_QRTL"] = df_out["INCOME_QRTL"].astype("int8")
 
     # OR return
     df_out["OR_RETURN"] = (df_in["I10_NPR"].fillna(0) + df_in["NPR"].fillna(0)) > 1
 
     # SSI
     dx_cols = get_dx_cols(df_in.columns)
-    df_out["SSI"] = df_in[dx_cols].isin(ssi_codes).any("columns")
+    ssi_matcher = IcdMatcher.from_codes(exact=ssi_codes)
+    df_out["SSI"] = ssi_matcher.any(df_in, dx_cols)
 
     for key, lookup_table in categorical_lookup.items():
         # FEMALE is 0, 1, but all other columns don't have a 0 val
-        if key == "SEX":
-            df_out["FEMALE"] = df_out["FEMALE"].apply(lambda x: lookup_table[x])
-        else:
-            df_out[key] = df_out[key].apply(lambda x: lookup_table[x - 1])
+        col = "FEMALE" if key == "SEX" else key
+        codes = df_out[col] if key == "SEX" else df_out[col] - 1
+
+        # from_codes would silently turn out-of-range codes into NaN
+        invalid = ~codes.between(0, len(lookup_table) - 1)
+        if invalid.any():
+            raise ValueError(
+                f"Invalid {col} codes {sorted(df_out.loc[invalid, col].unique())} "
+                f"for rows: {invalid[invalid].index.to_list()}"
+            )
+
+        df_out[col] = pd.Categorical.from_codes(codes, categories=lookup_table)
 
     df_out = df_out.rename(columns={"FEMALE": "SEX"})
 
-    # Get CCI score
-    df_out["cci_score"] = df_in[dx_cols].apply(
-        lambda row: get_cci_score(row.to_list()), axis=1
-    )
+    # Get CCI score. Points summed over all dx columns can pass 127, so this
+    # needs int16 (a wrapped int8 score could turn negative)
+    df_out["cci_score"] = get_cci_scores(df_in, dx_cols).astype("int16")
 
     # Build composite comorbidities
     for new_col, (cmr_col, cm_col) in composite_comorbidities.items():
-        # If there's not at least 1, we probably got the column name wrong
-        assert df_in[cmr_col].fillna(0).sum() > 0
-        assert df_in[cm_col].fillna(0).sum() > 0
-
         df_out[new_col] = df_in[cmr_col].fillna(0) + df_in[cm_col].fillna(0)
-        df_out[new_col] = df_out[new_col].astype(int)
+        df_out[new_col] = df_out[new_col].astype("int8")
 
     # Get presenting dx
-    def get_presenting_dx(row):
-        if "I10_DX1" in row and row["I10_DX1"] != "" and row["I10_DX1"] is not None:
-            code = row["I10_DX1"]
+    df_in["condition"] = get_presenting_dx(df_in[dx_cols])
+    df_out["condition"] = df_in["condition"].astype(
+        pd.CategoricalDtype(categories=list(DX_CODES.keys()))
+    )
+
+    df_out["PROLONGED_LOS"] = get_prolonged_los(
+        df_in["condition"], df_in["LOS"], los_thresholds
+    ).astype("int8")
+
+    return df_out
 
-        elif "DX1" in row and row["DX1"] != "" and row["DX1"] is not None:
-            code = row["DX1"]
-        else:
-            raise ValueError(f"No initial Dx for row: {row}")
 
-        for key, val in DX_CODES.items():
-            if code in val:
-                return key
+if __name__ == "__main__":
+    stage_cache = StageCache(
+        "process",
+        inputs=["cache/filtered.parquet", __file__],
+        outputs=[
+            "cache/processed.parquet",
+            "cache/processed.csv",
+            "cache/los_thresholds.json",
+        ],
+        params={
+            "DX_CODES": DX_CODES,
+            "ssi_codes": ssi_codes,
+            "CCI": CCI,
+            "categorical_lookup": categorical_lookup,
+            "composite_comorbidities": composite_comorbidities,
+            "prolonged_los_quantile": prolonged_los_quantile,
+        },
+    )
+    stage_cache.skip_if_fresh()
+
+    # Two passes over the cohort, either in one go or chunk by chunk: the first
+    # gets the global LOS thresholds (and sanity-checks the comorbidity
+    # columns), the second derives and writes the processed rows
+    in_path = "cache/filtered.parquet"
+    scan_cols = [
+        c
+        for c in pq.read_schema(in_path).names
+        if c in ["DX1", "I10_DX1", "LOS"] + composite_cols
+    ]
+
+    los_sketch = LosQuantileSketch()
+    comorbidity_counts = pd.Series(0, index=composite_cols)
+    n_rows = 0
+
+    for df_in in iter_parquet(in_path, columns=scan_cols, chunk_size=chunk_size):
+        condition = get_presenting_dx(df_in)
+
+        # In memory the whole cohort is a single chunk, so the thresholds come
+        # straight from one groupby; only streamed chunks need the sketch
+        if chunk_size is None:
+            los_thresholds = get_los_thresholds(
+                condition, df_in["LOS"], prolonged_los_quantile
+            )
         else:
-            raise ValueError(f"Couldn't find dx {code}")
+            los_sketch.update(condition, df_in["LOS"])
+
+        comorbidity_counts += df_in[composite_cols].fillna(0).sum()
+        n_rows += len(df_in)
 
-    df_in["condition"] = df_in[dx_cols].apply(get_presenting_dx, axis=1)
-    df_out["condition"] = df_in["condition"]
+    # If there's not at least 1, we probably got the column name wrong
+    if n_rows > 0:
+        for cmr_col, cm_col in composite_comorbidities.values():
+            assert comorbidity_counts[cmr_col] > 0
+            assert comorbidity_counts[cm_col] > 0
+    else:
+        logging.warning(f"No admissions in {in_path}")
 
     # Prolonged LOS
-    def set_prolonged_los(row):
-        """
-        Set based on 90th percentile for each condition
-        """
-        if row["condition"] == "acute_appendicitis":
-            return int(row["LOS"] > 5)
-        elif row["condition"] == "acute_cholecystitis":
-            return int(row["LOS"] > 6)
-        elif row["condition"] == "perforated_diverticulitis":
-            return int(row["LOS"] > 9)
-        else:
-            raise ValueError(f"Invalid condition: {row['condition']}")
+    if chunk_size is not None:
+        los_thresholds = los_sketch.quantiles(prolonged_los_quantile)
+    logging.info(f"Prolonged LOS thresholds: {los_thresholds}")
+    save_los_thresholds(
+        los_thresholds, prolonged_los_quantile, "cache/los_thresholds.json"
+    )
+
+    # iter_parquet always gives at least one (possibly empty) chunk, so both
+    # outputs get written, with the processed schema, even for an empty cohort
+    chunks = iter_parquet(in_path, chunk_size=chunk_size)
+    df_out = process_chunk(next(chunks), los_thresholds)
+    table = pa.Table.from_pandas(df_out, preserve_index=False)
+
+    # Categoricals are written as dictionary-encoded columns, and come back as
+    # categoricals (same categories, same order) on read
+    with pq.ParquetWriter("cache/processed.parquet", table.schema) as writer:
+        writer.write_table(table)
+        df_out.to_csv("cache/processed.csv", index=False)
 
-    df_out["PROLONGED_LOS"] = df_in.apply(set_prolonged_los, axis=1)
+        for df_in in chunks:
+            df_out = process_chunk(df_in, los_thresholds)
+            writer.write_table(pa.Table.from_pandas(df_out, preserve_index=False))
+            df_out.to_csv("cache/processed.csv", index=False, mode="a", header=False)
 
-    df_out.to_parquet("cache/processed.parquet", index=False)
-    df_out.to_csv("cache/processed.csv", index=False)
+    write_arrow_copy("cache/processed.parquet")
+    stage_cache.commit()
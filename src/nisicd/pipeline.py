@@ -0,0 +1,339 @@
+"""
+Run the whole pipeline, from the raw NIS files to the reporting outputs
+
+Stages are declared with the files they read and write; a stage depends on
+the stages that write its inputs. Each stage runs as `python -m <module>` from
+the project root (stages use paths relative to it), as soon as everything it
+depends on has finished, so independent branches (e.g. table1, sigtest and
+internalsigtest) run concurrently.
+
+Stages check their own StageCache, but starting a stage only to have it exit
+costs its imports, so the pipeline also records each stage run and skips a
+stage outright while the inputs, outputs and package sources the stage
+recorded are unchanged since then (stage parameters are module constants, so
+they can only change with the sources).
+"""
+import argparse
+import glob
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Dict, List, Set
+
+from nisicd import logging
+from nisicd.stageCache import StageCache
+
+
+@dataclass
+class Stage:
+    name: str
+    module: str
+    inputs: List[str] = field(default_factory=list)
+    outputs: List[str] = field(default_factory=list)
+
+
+stages = [
+    Stage(
+        "firstPassFilter",
+        "nisicd.dataProcessing.firstPassFilter",
+        inputs=["data/*.parquet"],
+        outputs=["cache/appendicitis.parquet"],
+    ),
+    Stage(
+        "inclusionCriteria",
+        "nisicd.dataProcessing.inclusionCriteria",
+        inputs=["cache/appendicitis.parquet"],
+        outputs=["cache/filtered.parquet", "cache/attrition.csv"],
+    ),
+    Stage(
+        "process",
+        "nisicd.dataProcessing.process",
+        inputs=["cache/filtered.parquet"],
+        outputs=[
+            "cache/processed.parquet",
+            "cache/processed.csv",
+            "cache/los_thresholds.json",
+        ],
+    ),
+    Stage(
+        "table1",
+        "nisicd.reporting.table1",
+        inputs=["cache/processed.parquet"],
+        outputs=[
+            "results/table1.docx",
+            "results/t1_insured.csv",
+            "results/t1_uninsured.csv",
+        ],
+    ),
+    Stage(
+        "sigtest",
+        "nisicd.reporting.sigtest",
+        inputs=["cache/processed.parquet"],
+        outputs=["results/regression.db", "results/regression.csv"],
+    ),
+    Stage(
+        "internalsigtest",
+        "nisicd.reporting.internalsigtest",
+        inputs=["cache/processed.parquet"],
+        outputs=["results/internal_dependencies.csv"],
+    ),
+    Stage(
+        "table2",
+        "nisicd.reporting.table2",
+        inputs=["results/regression.db"],
+        outputs=["results/table2.docx"],
+    ),
+    Stage(
+        "table3",
+        "nisicd.reporting.table3",
+        inputs=["results/regression.db"],
+        outputs=["results/table3.docx"],
+    ),
+    Stage(
+        "fplots",
+        "nisicd.reporting.fplots",
+        inputs=["results/regression.db", "results/internal_dependencies.csv"],
+        outputs=["results/fig1.png"]
+        + [
+            f"results/fig_internal_{predictor}.png"
+            for predictor in ["APRDRG_Severity", "APRDRG_Risk_Mortality", "cci_score"]
+        ],
+    ),
+]
+
+
+def get_dependencies(stages: List[Stage]) -> Dict[str, Set[str]]:
+    """
+    For each stage, the stages that write any of its inputs
+    """
+    producers = dict()
+    for stage in stages:
+        for path in stage.outputs:
+            if path in producers:
+                raise ValueError(
+                    f"{path} is an output of both {producers[path]} and {stage.name}"
+                )
+
+            producers[path] = stage.name
+
+    return {
+        stage.name: {producers[p] for p in stage.inputs if p in producers}
+        for stage in stages
+    }
+
+
+def get_order(stages: List[Stage]) -> List[str]:
+    """
+    Stage names in dependency order (declaration order among ready stages)
+    """
+    dependencies = get_dependencies(stages)
+    order = list()
+
+    while len(order) < len(stages):
+        ready = [
+            s.name
+            for s in stages
+            if s.name not in order and dependencies[s.name] <= set(order)
+        ]
+
+        if len(ready) == 0:
+            raise ValueError(
+                f"Dependency cycle among {[s.name for s in stages if s.name not in order]}"
+            )
+
+        order += ready
+
+    return order
+
+
+def select_stages(stages: List[Stage], targets: List[str]) -> List[Stage]:
+    """
+    The target stages and everything upstream of them
+    """
+    dependencies = get_dependencies(stages)
+
+    unknown = [t for t in targets if t not in dependencies]
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown stages: {unknown}")
+
+    selected, frontier = set(), list(targets)
+    while len(frontier) > 0:
+        name = frontier.pop()
+
+        if name not in selected:
+            selected.add(name)
+            frontier += list(dependencies[name])
+
+    return [s for s in stages if s.name in selected]
+
+
+def get_stage_env(hash_seed: str = "0") -> Dict[str, str]:
+    """
+    Environment for stage processes: a fixed hash seed, and a single BLAS
+    thread per process (stages parallelize with their own process pools, and a
+    fixed thread count keeps floating point reductions in the same order)
+    """
+    env = dict(os.environ)
+    env["PYTHONHASHSEED"] = hash_seed
+
+    for var in ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]:
+        env.setdefault(var, "1")
+
+    return env
+
+
+def get_run_cache(stage: Stage) -> StageCache:
+    """
+    Pipeline-level cache entry for a stage, covering the inputs, sources and
+    outputs the stage recorded on its last run, plus its declared inputs (e.g.
+    a new raw data file matching the pattern) and outputs. None if the stage
+    has never completed
+    """
+    run_cache = StageCache(f"pipeline:{stage.name}")
+    recorded = run_cache.manifest["stages"].get(stage.name)
+
+    if recorded is None:
+        return None
+
+    inputs = set(recorded["inputs"]) | set(recorded.get("sources", dict()))
+    for pattern in stage.inputs:
+        inputs.update(glob.glob(pattern))
+
+    run_cache.inputs = sorted(inputs)
+    run_cache.outputs = sorted(set(recorded["outputs"]) | set(stage.outputs))
+    run_cache.params = {"stage_key": recorded["key"]}
+
+    return run_cache
+
+
+def run_stage(stage: Stage, log_dir: str, env: Dict[str, str]) -> int:
+    """
+    Run a single stage, with its output going to its own log file
+    """
+    with open(os.path.join(log_dir, f"{stage.name}.log"), "w") as log:
+        return subprocess.run(
+            [sys.executable, "-m", stage.module],
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            env=env,
+        ).returncode
+
+
+def run_pipeline(
+    stages: List[Stage],
+    max_parallel: int = None,
+    log_dir: str = "cache/logs",
+    hash_seed: str = "0",
+) -> bool:
+    """
+    Run stages as soon as their dependencies have finished. After a failure,
+    stages that don't depend on it still run; returns whether all stages did
+    """
+    dependencies = get_dependencies(stages)
+    order = get_order(stages)
+    stage_lookup = {s.name: s for s in stages}
+
+    os.makedirs(log_dir, exist_ok=True)
+    env = get_stage_env(hash_seed)
+
+    pending, running, done, failed = list(order), dict(), set(), set()
+    start_times = dict()
+    pipeline_start = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=max_parallel or len(stages)) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            # pending is in dependency order, so stages after a skipped one see
+            # it as done in the same pass
+            for name in list(pending):
+                if not dependencies[name] <= done:
+                    continue
+
+                pending.remove(name)
+                run_cache = get_run_cache(stage_lookup[name])
+
+                if run_cache is not None and run_cache.is_fresh():
+                    logging.info(f"[*] {name} is up to date, skipping")
+                    done.add(name)
+                    continue
+
+                logging.info(f"[*] Starting {name}")
+                start_times[name] = time.monotonic()
+                future = executor.submit(run_stage, stage_lookup[name], log_dir, env)
+                running[future] = name
+
+            if len(running) == 0:
+                # Everything left depends on a failed stage
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                elapsed = time.monotonic() - start_times[name]
+
+                if future.result() == 0:
+                    done.add(name)
+                    logging.info(f"[+] {name} done ({elapsed:.1f}s)")
+
+                    run_cache = get_run_cache(stage_lookup[name])
+                    if run_cache is not None:
+                        run_cache.commit()
+                else:
+                    failed.add(name)
+                    logging.error(
+                        f"[-] {name} failed ({elapsed:.1f}s), "
+                        f"see {os.path.join(log_dir, f'{name}.log')}"
+                    )
+
+    if len(pending) > 0:
+        logging.error(f"[-] Not run because of failed dependencies: {pending}")
+
+    logging.info(
+        f"Pipeline finished in {time.monotonic() - pipeline_start:.1f}s: "
+        f"{len(done)} stages done, {len(failed)} failed, {len(pending)} not run"
+    )
+
+    return len(done) == len(stages)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog="nisicd",
+        description="Run the pipeline (from the project root), skipping fresh stages",
+    )
+    parser.add_argument(
+        "targets",
+        nargs="*",
+        help="Stages to run, along with everything upstream of them (default: all)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Maximum number of stages to run at once (default: no limit)",
+    )
+    parser.add_argument(
+        "--log-dir", default="cache/logs", help="Where each stage's output goes"
+    )
+    parser.add_argument(
+        "--list", action="store_true", help="List the stages in order and exit"
+    )
+    args = parser.parse_args()
+
+    selected = select_stages(stages, args.targets) if args.targets else stages
+
+    if args.list:
+        dependencies = get_dependencies(selected)
+        for name in get_order(selected):
+            print(f"{name} <- {', '.join(sorted(dependencies[name])) or '(raw data)'}")
+
+        return 0
+
+    return 0 if run_pipeline(selected, args.jobs, args.log_dir) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,11 @@
 import pandas as pd
 import numpy as np
 import statsmodels.api as sm
+from typing import Dict, List
+
+# Insurance status factor shared by the sigtest models, and its coefficient
+insurance_factor = "C(InsuranceStatus, Treatment(reference='uninsured'))"
+insurance_term = f"{insurance_factor}[T.insured]"
 
 """
 Cross tab format:
@@ -23,3 +28,38 @@ def make_crosstab(
     crosstab[1, 1] = len(control_group[control_group[outcome_col] == 0])
 
     return sm.stats.Table2x2(crosstab)
+
+
+def make_crosstabs(
+    df: pd.DataFrame,
+    exposure_col: str,
+    outcome_cols: List[str],
+    exposed_value=1,
+) -> Dict[str, sm.stats.Table2x2]:
+    """
+    Same tables as make_crosstab, for every outcome at once, from a single
+    frame: rows where exposure_col == exposed_value are the exposure group and
+    all other rows are the control group. Outcomes must be 0 / 1
+
+    All tables come out of one bincount over an int8 cell-index matrix
+    """
+    # Checked before the int8 cast, which would wrap e.g. 256 to 0
+    not_binary = [c for c in outcome_cols if not df[c].isin([0, 1]).all()]
+    if len(not_binary) > 0:
+        raise ValueError(
+            f"Outcomes must be 0 / 1 (with no missing values): {not_binary}"
+        )
+
+    outcomes = df[outcome_cols].to_numpy(dtype=np.int8)
+
+    unexposed = (df[exposure_col] != exposed_value).to_numpy(dtype=np.int8)
+
+    # Each row's cell (0-3) in each outcome's 2x2 table, then offset by outcome
+    # so all the tables can be counted in one go
+    cells = 2 * unexposed[:, None] + (1 - outcomes)
+    cells = cells + 4 * np.arange(len(outcome_cols))[None, :]
+
+    counts = np.bincount(cells.ravel(), minlength=4 * len(outcome_cols))
+    counts = counts.reshape(len(outcome_cols), 2, 2).astype(float)
+
+    return {c: sm.stats.Table2x2(counts[i]) for i, c in enumerate(outcome_cols)}
@@ -1,5 +1,6 @@
 import pandas as pd
 from nisicd.dataProcessing import get_dx_cols, ssi_codes
+from nisicd.arrowCache import read_cache
 import statsmodels as sm
 from scipy.stats import ttest_ind
 
@@ -12,7 +13,7 @@ def prettyprint_or(ct):
 
 
 if __name__ == "__main__":
-    df = pd.read_parquet("cache/processed.parquet")
+    df = read_cache("cache/processed.parquet")
 
     # Drop anything that got transferred out
     df = df[df["TRAN_OUT"] == 0]
@@ -1,12 +1,13 @@
 import pandas as pd
 from nisicd.dataProcessing import get_dx_cols, dm_startswith_cods
+from nisicd.arrowCache import read_cache
 from statsmodels.stats.proportion import proportions_ztest
 
 
 if __name__ == "__main__":
-    dx_cols = get_dx_cols(pd.read_parquet("cache/processed.parquet").columns)
+    dx_cols = get_dx_cols(read_cache("cache/processed.parquet").columns)
 
-    ssi = pd.read_parquet(
+    ssi = read_cache(
         "cache/processed.parquet", columns=dx_cols + ["PAY1", "AGE", "has_DM"]
     )
 
@@ -0,0 +1,193 @@
+"""
+Nonparametric bootstrap CIs for the aggregated (covariate pattern) logit fits
+
+Resampling admissions with replacement only changes how many admissions fall in
+each (covariate pattern, outcome) cell, so a replicate is a single multinomial
+draw over those cells followed by a binomial fit on the resampled counts. Each
+replicate fit is warm-started from the point estimate, and replicates are
+spread over a process pool in fixed-size chunks, each with its own seed spawned
+from one SeedSequence, so results don't depend on the number of workers
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+from scipy.special import expit
+from scipy.stats import norm
+
+from nisicd import logging
+from nisicd.reporting.irls import fit_logistic, get_covariance
+from nisicd.reporting.regression import (
+    aggregate_patterns,
+    build_design,
+    formula_columns,
+    get_shared_design,
+    init_worker,
+)
+
+
+def _bootstrap_chunk(task) -> np.ndarray:
+    """
+    Coefficients for n_reps replicates (NaN for replicates that can't be fit,
+    e.g. a category with no admissions after resampling)
+    """
+    seed, n_reps, successes, trials, start_params = task
+    rng = np.random.default_rng(seed)
+    X = get_shared_design()
+
+    cell_counts = np.concatenate([successes, trials - successes])
+    n_patterns = len(successes)
+
+    params = np.full((n_reps, X.shape[1]), np.nan)
+    for rep in range(n_reps):
+        resampled = rng.multinomial(cell_counts.sum(), cell_counts / cell_counts.sum())
+        resampled_successes = resampled[:n_patterns]
+        resampled_trials = resampled_successes + resampled[n_patterns:]
+
+        try:
+            res = fit_logistic(
+                X,
+                resampled_successes,
+                trials=resampled_trials,
+                start_params=start_params,
+            )
+        except np.linalg.LinAlgError:
+            continue
+
+        params[rep] = res.params.to_numpy()
+
+    return params
+
+
+def get_acceleration(
+    X: np.ndarray, successes: np.ndarray, trials: np.ndarray, params: np.ndarray
+) -> np.ndarray:
+    """
+    BCa acceleration for each coefficient, from the empirical influence of
+    every admission (computed per cell, then weighted by cell counts) rather
+    than from a jackknife, which would take one refit per cell
+    """
+    p = expit(X @ params)
+    inv_information = get_covariance(X, params, trials)
+
+    # Influence of an admission in pattern j with outcome y: I^-1 x_j (y - p_j)
+    influence = np.concatenate(
+        [(X * (1 - p)[:, None]) @ inv_information, (X * -p[:, None]) @ inv_information]
+    )
+    weights = np.concatenate([successes, trials - successes])[:, None]
+
+    return np.sum(weights * influence**3, axis=0) / (
+        6 * np.sum(weights * influence**2, axis=0) ** 1.5
+    )
+
+
+def get_bootstrap_cis(
+    boot_params: np.ndarray,
+    params: np.ndarray,
+    acceleration: np.ndarray,
+    alpha: float = 0.05,
+) -> Dict[str, np.ndarray]:
+    """
+    Percentile and BCa intervals for each coefficient, on the log-odds scale
+    """
+    z = norm.ppf([alpha / 2, 1 - alpha / 2])
+    cis = {
+        c: np.full(len(params), np.nan)
+        for c in ["pct_lo", "pct_hi", "bca_lo", "bca_hi"]
+    }
+
+    for k in range(len(params)):
+        boot = boot_params[:, k][~np.isnan(boot_params[:, k])]
+
+        if len(boot) == 0:
+            continue
+
+        cis["pct_lo"][k], cis["pct_hi"][k] = np.quantile(
+            boot, [alpha / 2, 1 - alpha / 2]
+        )
+
+        # Bias correction (median bias of the replicates) and acceleration
+        z0 = norm.ppf(np.mean(boot < params[k]))
+        adjusted = norm.cdf(z0 + (z0 + z) / (1 - acceleration[k] * (z0 + z)))
+
+        if np.all(np.isfinite(adjusted)):
+            cis["bca_lo"][k], cis["bca_hi"][k] = np.quantile(boot, adjusted)
+
+    return cis
+
+
+def bootstrap_outcomes(
+    df: pd.DataFrame,
+    outcome_cols: List[str],
+    rhs: str,
+    n_boot: int = 2000,
+    seed: int = 42,
+    alpha: float = 0.05,
+    chunk_size: int = 50,
+    max_workers: int = None,
+) -> Dict[str, pd.DataFrame]:
+    """
+    Bootstrap percentile and BCa CIs (as odds ratios) for every term of each
+    outcome's model, indexed by term like the fit_outcomes results
+    """
+    if max_workers is None:
+        max_workers = len(os.sched_getaffinity(0))
+
+    covariate_cols = formula_columns(df.columns, rhs)
+    patterns = aggregate_patterns(df, covariate_cols, outcome_cols)
+
+    design = build_design(patterns, rhs)
+    patterns = patterns.loc[design.index]
+    trials = patterns["trials"].to_numpy()
+    X = design.to_numpy(dtype=float)
+
+    chunk_sizes = [min(chunk_size, n_boot - i) for i in range(0, n_boot, chunk_size)]
+
+    logging.info(
+        f"Bootstrapping {len(outcome_cols)} outcomes ({n_boot} replicates over "
+        f"{X.shape[0]} covariate patterns) with {max_workers} processes"
+    )
+
+    results = dict()
+    with ProcessPoolExecutor(
+        max_workers=max_workers, initializer=init_worker, initargs=(X,)
+    ) as executor:
+        for outcome_seed, outcome_col in zip(
+            np.random.SeedSequence(seed).spawn(len(outcome_cols)), outcome_cols
+        ):
+            successes = patterns[outcome_col].to_numpy()
+            params = fit_logistic(X, successes, trials=trials).params.to_numpy()
+
+            tasks = [
+                (chunk_seed, n_reps, successes, trials, params)
+                for chunk_seed, n_reps in zip(
+                    outcome_seed.spawn(len(chunk_sizes)), chunk_sizes
+                )
+            ]
+            boot_params = np.concatenate(list(executor.map(_bootstrap_chunk, tasks)))
+
+            n_failed = np.isnan(boot_params).any(axis=1).sum()
+            if n_failed > 0:
+                logging.warning(
+                    f"{n_failed} of {n_boot} bootstrap fits failed for {outcome_col}"
+                )
+
+            cis = get_bootstrap_cis(
+                boot_params,
+                params,
+                get_acceleration(X, successes, trials, params),
+                alpha=alpha,
+            )
+            results[outcome_col] = pd.DataFrame(
+                {
+                    "boot_lower_ci": np.exp(cis["pct_lo"]),
+                    "boot_upper_ci": np.exp(cis["pct_hi"]),
+                    "bca_lower_ci": np.exp(cis["bca_lo"]),
+                    "bca_upper_ci": np.exp(cis["bca_hi"]),
+                },
+                index=design.columns,
+            )
+
+    return results
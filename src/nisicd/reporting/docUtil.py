@@ -3,10 +3,13 @@ Convenience functions for creating word document tables
 """
 
 from typing import List
+from xml.sax.saxutils import escape
 
 import docx
 import pandas as pd
 from docx.enum.style import WD_STYLE_TYPE
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls, qn
 from docx.shared import Pt
 
 
@@ -56,6 +59,59 @@ class DocTable:
         for idx, txt in enumerate(row_elements):
             new_row[idx].paragraphs[0].add_run(txt)
 
+        self.nrows += 1
+
+    def _cell_xml(self, txt: str, width: int, bold: bool) -> str:
+        run = ""
+        if txt is not None:
+            # Same as python-docx: keep leading / trailing whitespace
+            space = ' xml:space="preserve"' if txt != txt.strip() else ""
+            run = (
+                f"<w:r>{'<w:rPr><w:b/></w:rPr>' if bold else ''}"
+                f"<w:t{space}>{escape(txt)}</w:t></w:r>"
+            )
+
+        return (
+            f'<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="{width}"/></w:tcPr>'
+            f'<w:p><w:pPr><w:pStyle w:val="{self.text_style.style_id}"/></w:pPr>'
+            f"{run}</w:p></w:tc>"
+        )
+
+    def add_rows(self, rows: List[List[str]], bold: bool = False):
+        """
+        Add many rows at once, producing the same XML as add_row would
+
+        The rows' XML is generated as a single string and parsed in one go,
+        rather than going through python-docx cell by cell, so time is linear
+        in the number of cells
+        """
+        widths = [
+            grid_col.get(qn("w:w")) for grid_col in self.table._tbl.tblGrid.gridCol_lst
+        ]
+
+        for row in rows:
+            if len(row) > self.ncolumns:
+                raise ValueError(
+                    f"Row has {len(row)} elements but table has {self.ncolumns} columns"
+                )
+
+        rows_xml = "".join(
+            "<w:tr>"
+            + "".join(
+                self._cell_xml(
+                    str(row[idx]) if idx < len(row) else None, widths[idx], bold
+                )
+                for idx in range(self.ncolumns)
+            )
+            + "</w:tr>"
+            for row in rows
+        )
+
+        for tr in parse_xml(f"<w:tbl {nsdecls('w')}>{rows_xml}</w:tbl>"):
+            self.table._tbl.append(tr)
+
+        self.nrows += len(rows)
+
     def rename_rows(self, mapper: dict):
         """
         Locate rows with a specific value in first column and change to specified value
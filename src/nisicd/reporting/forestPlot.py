@@ -0,0 +1,120 @@
+"""
+Forest plots of odds ratios, optionally grouped (e.g. outcome -> payer rows)
+
+All rows go through a single errorbar call, and rendered figures are cached:
+a figure is only redrawn if the data plotted in it, the plot options or this
+module have changed since it was last written
+"""
+import hashlib
+import json
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from matplotlib.ticker import FormatStrFormatter
+
+from nisicd.stageCache import StageCache
+
+
+def hash_frame(df: pd.DataFrame) -> str:
+    """
+    Content hash of a frame's values (in row order) and column names. The
+    index isn't plotted, so it doesn't count
+    """
+    digest = hashlib.sha256(
+        pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes()
+    )
+    digest.update(json.dumps([str(c) for c in df.columns]).encode("utf-8"))
+
+    return digest.hexdigest()
+
+
+def plot_forest(
+    df: pd.DataFrame,
+    label_col: str,
+    group_col: str = None,
+    or_col: str = "odds_ratio",
+    lower_col: str = "lower_ci",
+    upper_col: str = "upper_ci",
+    log_scale: bool = False,
+    row_height: float = 0.33,
+):
+    """
+    One row per df row, top to bottom in df order. With group_col, consecutive
+    rows of the same group go under a bold heading row
+    """
+    odds_ratios = df[or_col].to_numpy(dtype=float)
+    labels = df[label_col].astype(str).to_numpy()
+
+    if group_col is None:
+        y = np.arange(len(df))
+        headings, heading_y = np.array([], dtype=str), np.array([], dtype=int)
+    else:
+        groups = df[group_col].astype(str).to_numpy()
+        new_group = np.r_[True, groups[1:] != groups[:-1]]
+
+        # Every group's rows shift down one more slot, to make room for its heading
+        y = np.arange(len(df)) + np.cumsum(new_group)
+        headings, heading_y = groups[new_group], y[new_group] - 1
+
+    n_slots = len(y) + len(heading_y)
+    fig, ax = plt.subplots(figsize=(10, row_height * n_slots), dpi=150)
+    ax.errorbar(
+        x=odds_ratios,
+        y=y,
+        xerr=np.vstack(
+            [
+                odds_ratios - df[lower_col].to_numpy(dtype=float),
+                df[upper_col].to_numpy(dtype=float) - odds_ratios,
+            ]
+        ),
+        color="black",
+        capsize=3,
+        linestyle="None",
+        linewidth=1,
+        marker="o",
+        markersize=5,
+        mfc="black",
+        mec="black",
+    )
+    ax.axvline(1, color="grey", linestyle="--", linewidth=0.8)
+
+    ax.set_yticks(np.concatenate([y, heading_y]))
+    ax.set_yticklabels(np.concatenate([labels, headings]))
+    for tick_label in ax.get_yticklabels()[len(y) :]:
+        tick_label.set_fontweight("bold")
+
+    # Top to bottom
+    ax.set_ylim(n_slots - 0.5, -0.5)
+
+    if log_scale:
+        ax.set_xscale("log")
+        ax.xaxis.set_major_formatter(FormatStrFormatter("%g"))
+        ax.xaxis.set_minor_formatter(FormatStrFormatter("%g"))
+
+    ax.set_xlabel("Odds Ratio")
+
+    return fig
+
+
+def save_forest(df: pd.DataFrame, path: str, **plot_kwargs) -> bool:
+    """
+    Render df to path unless the figure there was already rendered from the
+    same data and options. Returns whether the figure was (re)rendered
+    """
+    figure_cache = StageCache(
+        f"figure:{path}",
+        inputs=[__file__],
+        outputs=[path],
+        params={"data": hash_frame(df), "plot": plot_kwargs},
+    )
+
+    if figure_cache.is_fresh():
+        return False
+
+    fig = plot_forest(df, **plot_kwargs)
+    fig.savefig(path, bbox_inches="tight")
+    plt.close(fig)
+
+    figure_cache.commit()
+    return True
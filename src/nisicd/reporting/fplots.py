@@ -1,43 +1,61 @@
-import forestplot as fp
-import matplotlib.pyplot as plt
 import pandas as pd
 
-from nisicd.reporting.docUtil import DocTable
+from nisicd import logging
+from nisicd.reporting import insurance_term
+from nisicd.reporting.forestPlot import save_forest
+from nisicd.reporting.resultStore import ResultStore
+from nisicd.stageCache import StageCache
+
+predictors = ["APRDRG_Severity", "APRDRG_Risk_Mortality", "cci_score"]
 
 if __name__ == "__main__":
-    dt = DocTable(["Characteristic", "Adjusted Odds Ratio (Insured vs. Uninsured)"])
-    plottable_df = pd.DataFrame()
-    # First figure
-    for comorbidity_measure in [
-        "APRDRG_Risk_Mortality",
-        "APRDRG_Severity",
-        "cci_score",
-    ]:
-        results = pd.read_csv(
-            f"results/{comorbidity_measure}_regression.csv", index_col=0
+    stage_cache = StageCache(
+        "fplots",
+        inputs=[
+            "results/regression.db",
+            "results/internal_dependencies.csv",
+            __file__,
+        ],
+        outputs=["results/fig1.png"]
+        + [f"results/fig_internal_{predictor}.png" for predictor in predictors],
+    )
+    stage_cache.skip_if_fresh()
+
+    # First figure: insured vs. uninsured ORs for each comorbidity metric
+    plottable_df = (
+        ResultStore("results/regression.db")
+        .lookup(
+            "sigtest",
+            insurance_term,
+            ["APRDRG_Risk_Mortality", "APRDRG_Severity", "cci_score"],
         )
+        .rename_axis("variable")
+        .reset_index()
+    )
+
+    save_forest(plottable_df, "results/fig1.png", label_col="variable")
 
-        # Insurance status should be first
-        assert results.index[1].startswith("C(InsuranceStatus,")
-
-        results["variable"] = comorbidity_measure
-        plottable_df = plottable_df.append(results.iloc[1], ignore_index=True)
-
-    print("Done")
-
-    plt.figure(figsize=(10, 1), dpi=150)
-    plt.errorbar(
-        x=plottable_df["odds_ratio"].to_numpy(),
-        y=plottable_df["variable"].to_numpy(),
-        xerr=plottable_df[["lower_ci", "upper_ci"]].transpose().to_numpy(),
-        color="black",
-        capsize=3,
-        linestyle="None",
-        linewidth=1,
-        marker="o",
-        markersize=5,
-        mfc="black",
-        mec="black",
+    # Internal dependencies: for each comorbidity metric, its OR for every
+    # outcome in every payer subgroup, grouped by outcome
+    internal_df = pd.read_csv("results/internal_dependencies.csv")
+    internal_df = internal_df.sort_values(["dependent_var", "payer"]).reset_index(
+        drop=True
     )
 
-    plt.savefig("results/fig1.png", bbox_inches="tight")
+    for predictor, predictor_df in internal_df.groupby("predictor_var"):
+        if predictor not in predictors:
+            continue
+
+        rendered = save_forest(
+            predictor_df,
+            f"results/fig_internal_{predictor}.png",
+            label_col="payer",
+            group_col="dependent_var",
+            or_col="OR",
+            log_scale=True,
+        )
+
+        if not rendered:
+            logging.info(f"Forest plot for {predictor} is up to date, skipping")
+
+    stage_cache.commit()
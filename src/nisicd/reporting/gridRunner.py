@@ -0,0 +1,159 @@
+"""
+Parallel runner for grids of subgroup x outcome x predictor logistic fits
+
+The data is partitioned by subgroup once and written as uncompressed Arrow IPC
+files, which worker processes memory-map read-only instead of each receiving a
+pickled copy. Fits are logged as they complete, and the output CSV is written
+once they're all done, in grid order.
+"""
+import csv
+import itertools
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import List
+
+import pandas as pd
+import pyarrow as pa
+
+from nisicd import logging
+from nisicd.reporting.regression import build_design, fit_logit, formula_columns
+
+
+@dataclass
+class GridSpec:
+    subgroup_col: str
+    subgroups: List[str]
+    outcomes: List[str]
+    predictors: List[str]
+    covariates: List[str] = field(default_factory=list)
+
+    def cells(self):
+        return itertools.product(self.subgroups, self.outcomes, self.predictors)
+
+
+# Columns of the output CSV, one row per grid cell
+grid_columns = [
+    "payer",
+    "predictor_var",
+    "dependent_var",
+    "OR",
+    "lower_ci",
+    "upper_ci",
+    "pval",
+]
+
+# Memory-mapped partitions, opened at most once per worker process
+_partitions = dict()
+
+
+def _load_partition(path: str) -> pd.DataFrame:
+    if path not in _partitions:
+        with pa.memory_map(path, "r") as source:
+            # Zero-copy where possible, so workers share the mapped pages
+            table = pa.ipc.open_file(source).read_all()
+            _partitions[path] = table.to_pandas(split_blocks=True)
+
+    return _partitions[path]
+
+
+def _fit_cell(task) -> dict:
+    partition_path, subgroup, outcome, predictor, covariates, backend = task
+    df = _load_partition(partition_path)
+
+    X = build_design(df, " + ".join([predictor] + covariates))
+    y = df.loc[X.index, outcome].astype(int).rename(outcome)
+    res_out = fit_logit(y, X, backend=backend)
+
+    return _get_row(subgroup, outcome, predictor, res_out.loc[predictor])
+
+
+def _get_row(
+    subgroup: str, outcome: str, predictor: str, stats: pd.Series = None
+) -> dict:
+    """
+    Output row for a grid cell, with empty stats if there was nothing to fit
+    """
+    return {
+        "payer": subgroup,
+        "predictor_var": predictor,
+        "dependent_var": outcome,
+        "OR": None if stats is None else stats["odds_ratio"],
+        "lower_ci": None if stats is None else stats["lower_ci"],
+        "upper_ci": None if stats is None else stats["upper_ci"],
+        "pval": None if stats is None else stats["pval"],
+    }
+
+
+def run_grid(
+    df: pd.DataFrame,
+    spec: GridSpec,
+    out_path: str,
+    backend: str = "statsmodels",
+    max_workers: int = None,
+    scratch_dir: str = "cache",
+) -> None:
+    if max_workers is None:
+        max_workers = len(os.sched_getaffinity(0))
+
+    used_cols = formula_columns(
+        df.columns, " + ".join(spec.outcomes + spec.predictors + spec.covariates)
+    )
+
+    with tempfile.TemporaryDirectory(prefix="grid-", dir=scratch_dir) as tmp_dir:
+        partition_paths = dict()
+
+        for idx, (subgroup, subgroup_df) in enumerate(
+            df[df[spec.subgroup_col].isin(spec.subgroups)].groupby(
+                spec.subgroup_col, observed=True
+            )
+        ):
+            logging.info(f"# of admissions for {subgroup}: {len(subgroup_df)}")
+            partition_paths[subgroup] = os.path.join(tmp_dir, f"{idx}.arrow")
+
+            table = pa.Table.from_pandas(subgroup_df[used_cols], preserve_index=False)
+            with pa.OSFile(partition_paths[subgroup], "wb") as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+
+        cells = list(spec.cells())
+        if len(cells) == 0:
+            logging.warning(f"Empty grid, writing only the header: {spec}")
+
+        empty_subgroups = [s for s in spec.subgroups if s not in partition_paths]
+        if len(empty_subgroups) > 0:
+            logging.warning(
+                f"No admissions for {empty_subgroups}, leaving their cells empty"
+            )
+
+        # Cells of empty subgroups have nothing to fit, so their rows are filled in
+        # up front and only the rest go to the pool
+        rows = [
+            _get_row(s, o, p) if s not in partition_paths else None for s, o, p in cells
+        ]
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(
+                    _fit_cell,
+                    (partition_paths[s], s, o, p, spec.covariates, backend),
+                ): idx
+                for idx, (s, o, p) in enumerate(cells)
+                if s in partition_paths
+            }
+
+            for future in as_completed(futures):
+                row = future.result()
+                rows[futures[future]] = row
+
+                logging.info(
+                    f"{row['payer']}: {row['predictor_var']} -> {row['dependent_var']} "
+                    f"OR {row['OR']:.2f} ({row['lower_ci']:.2f} - {row['upper_ci']:.2f})"
+                )
+
+    # Grid order, so identical runs give identical files
+    with open(out_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=grid_columns)
+        writer.writeheader()
+        writer.writerows(rows)
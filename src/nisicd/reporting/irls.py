@@ -0,0 +1,155 @@
+"""
+Vectorized IRLS (Newton-Raphson) logistic regression
+
+A drop-in for the statsmodels Logit fits used in the sigtest models: results
+expose params / conf_int() / pvalues the same way, so they can go straight
+through summarize_fit. Outcomes are binomial counts, which covers both
+individual-level data (trials of 1) and aggregated covariate patterns
+"""
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from scipy.linalg import cho_factor, cho_solve
+from scipy.special import expit
+from scipy.stats import norm
+
+from nisicd import logging
+
+
+@dataclass
+class LogitResult:
+    params: pd.Series
+    bse: pd.Series
+    converged: bool
+    n_iter: int
+    llf: float
+
+    @property
+    def pvalues(self) -> pd.Series:
+        return pd.Series(
+            2 * norm.sf(np.abs(self.params / self.bse)), index=self.params.index
+        )
+
+    def conf_int(self, alpha: float = 0.05) -> pd.DataFrame:
+        """
+        Wald CIs, in the same two-column layout as statsmodels
+        """
+        q = norm.ppf(1 - alpha / 2)
+        return pd.DataFrame(
+            {0: self.params - q * self.bse, 1: self.params + q * self.bse}
+        )
+
+
+def _loglik(eta: np.ndarray, successes: np.ndarray, trials: np.ndarray) -> float:
+    # logaddexp keeps this finite for large |eta|, where exp() would overflow
+    return float(np.sum(successes * eta - trials * np.logaddexp(0, eta)))
+
+
+def _information(X, w: np.ndarray) -> np.ndarray:
+    """
+    X' W X, without densifying X if it's sparse (one-hot heavy designs)
+    """
+    if scipy.sparse.issparse(X):
+        return np.asarray((X.T @ X.multiply(w[:, None])).todense())
+
+    return X.T @ (X * w[:, None])
+
+
+def get_covariance(X, params: np.ndarray, trials=None) -> np.ndarray:
+    """
+    Covariance of the estimates at params (the inverse of the information)
+    """
+    p = expit(X @ params)
+    trials = np.ones_like(p) if trials is None else np.asarray(trials, float)
+
+    return np.linalg.inv(_information(X, trials * p * (1 - p)))
+
+
+def fit_logistic(
+    X,
+    successes,
+    trials=None,
+    start_params=None,
+    param_names=None,
+    max_iter: int = 100,
+    tol: float = 1e-8,
+    max_halvings: int = 30,
+) -> LogitResult:
+    """
+    Fit a logistic regression by IRLS with step-halving
+
+    X may be a DataFrame, a dense array or a scipy.sparse matrix. start_params
+    allows warm starts (e.g. from a related outcome's fit); they are only used
+    if they're at least as good a starting point as all zeros
+    """
+    if isinstance(X, pd.DataFrame):
+        param_names = list(X.columns)
+        X = X.to_numpy(dtype=float)
+    elif param_names is None:
+        param_names = [f"x{i}" for i in range(X.shape[1])]
+
+    successes = np.asarray(successes, dtype=float)
+    trials = np.ones_like(successes) if trials is None else np.asarray(trials, float)
+
+    beta = np.zeros(X.shape[1])
+    llf = _loglik(X @ beta, successes, trials)
+
+    if start_params is not None:
+        start_params = np.asarray(start_params, dtype=float)
+        start_llf = _loglik(X @ start_params, successes, trials)
+
+        if start_llf >= llf:
+            beta, llf = start_params, start_llf
+
+    converged, stalled = False, False
+    for n_iter in range(1, max_iter + 1):
+        p = expit(X @ beta)
+        score = X.T @ (successes - trials * p)
+        information = _information(X, trials * p * (1 - p))
+
+        # Raises LinAlgError if the information matrix is singular, same as
+        # the statsmodels fits
+        step = cho_solve(cho_factor(information), score)
+
+        # Halve the Newton step until the log-likelihood stops decreasing
+        for _ in range(max_halvings):
+            new_llf = _loglik(X @ (beta + step), successes, trials)
+            if new_llf >= llf - 1e-12:
+                break
+            step /= 2
+        else:
+            # No step along the Newton direction keeps the log-likelihood from
+            # decreasing, so stop at the current estimates
+            stalled = True
+            break
+
+        beta = beta + step
+        llf_change = new_llf - llf
+        llf = new_llf
+
+        if np.max(np.abs(step)) < tol or llf_change == 0:
+            converged = True
+            break
+
+    if stalled:
+        logging.warning(
+            f"IRLS step-halving failed to improve the fit at iteration {n_iter}, "
+            "estimates may be unreliable"
+        )
+    elif not converged:
+        logging.warning(
+            f"IRLS did not converge in {max_iter} iterations "
+            "(possible separation), estimates may be unreliable"
+        )
+
+    cov = get_covariance(X, beta, trials)
+
+    return LogitResult(
+        params=pd.Series(beta, index=param_names),
+        bse=pd.Series(np.sqrt(np.diag(cov)), index=param_names),
+        converged=converged,
+        n_iter=n_iter,
+        llf=llf,
+    )
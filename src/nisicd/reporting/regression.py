@@ -0,0 +1,255 @@
+"""
+Logistic regression runner for fitting several outcomes against one design
+
+The right-hand side of every sigtest model is the same, so the patsy design
+matrix is built once and shared with a pool of worker processes, each of which
+only has to receive its own outcome vector
+"""
+import ast
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Set
+
+import numpy as np
+import pandas as pd
+import statsmodels.api as sm
+from patsy import ModelDesc, dmatrix
+
+from nisicd import logging
+from nisicd.reporting.irls import fit_logistic
+
+
+def _observed_levels(s: pd.Series) -> pd.Series:
+    """
+    A categorical reduced to its observed values, in sorted order
+    """
+    s = s.cat.remove_unused_categories()
+    return s.cat.reorder_categories(sorted(s.cat.categories))
+
+
+def build_design(df: pd.DataFrame, rhs: str) -> pd.DataFrame:
+    """
+    Patsy design matrix for the right-hand side of a formula. Column names are
+    the same terms sm.logit would produce from the full formula
+
+    Patsy takes the levels of a categorical column (and so the reference level)
+    from its categories, so categoricals get the same levels here that they
+    would have as plain string columns
+    """
+    categorical_cols = [
+        c
+        for c in formula_columns(df.columns, rhs)
+        if isinstance(df[c].dtype, pd.CategoricalDtype)
+    ]
+
+    if len(categorical_cols) > 0:
+        df = df.assign(**{c: _observed_levels(df[c]) for c in categorical_cols})
+
+    return dmatrix(rhs, df, return_type="dataframe")
+
+
+def _factor_names(code: str) -> Set[str]:
+    """
+    Variables a patsy factor's code uses: plain names (not the functions
+    called, like C or Treatment) and the column names quoted in Q("...")
+    """
+    names, functions = set(), set()
+
+    for node in ast.walk(ast.parse(code.strip(), mode="eval")):
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            functions.add(id(node.func))
+
+            if (
+                node.func.id == "Q"
+                and len(node.args) == 1
+                and isinstance(node.args[0], ast.Constant)
+            ):
+                names.add(node.args[0].value)
+        elif isinstance(node, ast.Name) and id(node) not in functions:
+            names.add(node.id)
+
+    return names
+
+
+def formula_columns(all_cols, formula: str) -> List[str]:
+    """
+    Which of all_cols a formula refers to, e.g. RACE for "C(RACE) + AGE", or
+    "CANCER, SOLID" for 'Q("CANCER, SOLID")', going by patsy's parse of the
+    formula rather than searching its text
+    """
+    desc = ModelDesc.from_formula(formula)
+    names = set()
+
+    for term in desc.lhs_termlist + desc.rhs_termlist:
+        for factor in term.factors:
+            names |= _factor_names(factor.code)
+
+    return [c for c in all_cols if c in names]
+
+
+def summarize_fit(res) -> pd.DataFrame:
+    """
+    Odds ratios, Wald CIs and p-values for a fitted statsmodels result
+    """
+    return pd.DataFrame(
+        {
+            "odds_ratio": np.exp(res.params),
+            "lower_ci": np.exp(res.conf_int()[0]),
+            "upper_ci": np.exp(res.conf_int()[1]),
+            "pval": res.pvalues,
+        }
+    )
+
+
+def aggregate_patterns(
+    df: pd.DataFrame, covariate_cols: List[str], outcome_cols: List[str], age_bins=None
+) -> pd.DataFrame:
+    """
+    Collapse individual rows to unique covariate patterns, with a success count
+    per outcome and a "trials" count per pattern. A binomial fit on these gives
+    the same estimates as the individual-level fit
+
+    age_bins (anything pd.cut accepts) optionally coarsens AGE to bin midpoints
+    for even fewer patterns, at the cost of no longer being exact
+    """
+    covariates = df[covariate_cols].copy()
+
+    if age_bins is not None:
+        binned = pd.cut(covariates["AGE"], bins=age_bins, include_lowest=True)
+        covariates["AGE"] = np.asarray(binned.cat.categories.mid)[binned.cat.codes]
+
+    grouped = pd.concat([covariates, df[outcome_cols].astype(int)], axis=1).groupby(
+        covariate_cols, observed=True, dropna=False
+    )
+    patterns = grouped[outcome_cols].sum()
+    patterns["trials"] = grouped.size()
+
+    return patterns.reset_index()
+
+
+def fit_logit_result(
+    y: pd.Series,
+    X: pd.DataFrame,
+    backend: str = "statsmodels",
+    start_params=None,
+    trials: pd.Series = None,
+):
+    """
+    Fitted result object (statsmodels, or the IRLS LogitResult equivalent). If
+    trials are given, y holds success counts out of that many trials
+    """
+    if backend == "irls":
+        try:
+            return fit_logistic(X, y, trials=trials, start_params=start_params)
+        except np.linalg.LinAlgError as e:
+            logging.warning(
+                f"IRLS fit failed ({e}) for {y.name}. Falling back to statsmodels"
+            )
+    elif backend != "statsmodels":
+        raise ValueError(f"Unknown regression backend: {backend}")
+
+    if trials is not None:
+        endog = np.column_stack([y, trials - y])
+        return sm.GLM(endog, X, family=sm.families.Binomial()).fit()
+
+    lr = sm.Logit(y, X)
+
+    try:
+        res = lr.fit(disp=0)
+    except np.linalg.LinAlgError as e:
+        logging.warning(f"LR fit failed ({e}) for {y.name}. Attempting regularized fit")
+        res = lr.fit_regularized(disp=0)
+
+    return res
+
+
+def fit_logit(
+    y: pd.Series,
+    X: pd.DataFrame,
+    backend: str = "statsmodels",
+    trials: pd.Series = None,
+) -> pd.DataFrame:
+    return summarize_fit(fit_logit_result(y, X, backend=backend, trials=trials))
+
+
+# Design matrix shared with worker processes, set once per worker by the
+# pool initializer rather than pickled with every task
+_shared_design = None
+
+
+def init_worker(X) -> None:
+    """
+    Pool initializer, sharing the design X with every task run in the worker
+    """
+    global _shared_design
+    _shared_design = X
+
+
+def get_shared_design():
+    """
+    The design shared with this worker by init_worker
+    """
+    return _shared_design
+
+
+def _fit_shared(task) -> pd.DataFrame:
+    y, trials = task
+    return fit_logit(y, _shared_design, trials=trials)
+
+
+def fit_outcomes(
+    df: pd.DataFrame,
+    outcome_cols: List[str],
+    rhs: str,
+    backend: str = "statsmodels",
+    aggregate: bool = False,
+    age_bins=None,
+    max_workers: int = None,
+) -> Dict[str, pd.DataFrame]:
+    """
+    Fit one logistic regression per outcome, all sharing the same design
+
+    statsmodels fits run in parallel so that wall-clock is bounded by the
+    slowest single fit. IRLS fits take seconds, so they run serially instead,
+    each warm-started from the previous outcome's coefficients
+
+    With aggregate=True, rows are first collapsed to covariate patterns (see
+    aggregate_patterns) and binomial models are fit on the counts
+    """
+    trials = None
+
+    if aggregate:
+        covariate_cols = formula_columns(df.columns, rhs)
+        df = aggregate_patterns(df, covariate_cols, outcome_cols, age_bins=age_bins)
+
+    X = build_design(df, rhs)
+    ys = [df.loc[X.index, c].astype(int).rename(c) for c in outcome_cols]
+
+    if aggregate:
+        trials = df.loc[X.index, "trials"]
+
+    if backend == "irls":
+        results, start_params = list(), None
+
+        for y in ys:
+            res = fit_logit_result(
+                y, X, backend="irls", start_params=start_params, trials=trials
+            )
+            start_params = res.params
+            results.append(summarize_fit(res))
+
+        return dict(zip(outcome_cols, results))
+
+    if max_workers is None:
+        max_workers = min(len(outcome_cols), len(os.sched_getaffinity(0)))
+
+    logging.info(
+        f"Fitting {len(outcome_cols)} outcomes on a shared {X.shape} design "
+        f"with {max_workers} processes"
+    )
+    with ProcessPoolExecutor(
+        max_workers=max_workers, initializer=init_worker, initargs=(X,)
+    ) as executor:
+        results = list(executor.map(_fit_shared, [(y, trials) for y in ys]))
+
+    return dict(zip(outcome_cols, results))
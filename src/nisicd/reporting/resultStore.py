@@ -0,0 +1,130 @@
+"""
+SQLite store for regression results
+
+One row per (analysis, outcome, term), so reporting scripts can pull a single
+term (e.g. insurance status) for every outcome in one indexed query rather than
+reading a CSV per outcome and relying on the term's position in it
+"""
+import os
+import sqlite3
+from contextlib import contextmanager
+from typing import List
+
+import pandas as pd
+
+RESULTS_DB_PATH = "results/regression.db"
+
+# Per-term statistics that can be stored (bootstrap CIs are optional)
+result_cols = [
+    "odds_ratio",
+    "lower_ci",
+    "upper_ci",
+    "pval",
+    "boot_lower_ci",
+    "boot_upper_ci",
+    "bca_lower_ci",
+    "bca_upper_ci",
+]
+
+
+class ResultStore:
+    def __init__(self, path: str = RESULTS_DB_PATH) -> None:
+        self.path = path
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS results (
+                    analysis TEXT NOT NULL,
+                    outcome TEXT NOT NULL,
+                    term TEXT NOT NULL,
+                    term_order INTEGER NOT NULL,
+                    {", ".join(f"{c} REAL" for c in result_cols)},
+                    PRIMARY KEY (analysis, outcome, term)
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS results_term ON results (analysis, term)"
+            )
+
+    @contextmanager
+    def _connect(self):
+        """
+        Connection that commits (or rolls back) and closes on exit
+        """
+        conn = sqlite3.connect(self.path)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def clear(self, analysis: str) -> None:
+        """
+        Drop all results for an analysis, e.g. before rerunning it
+        """
+        with self._connect() as conn:
+            conn.execute("DELETE FROM results WHERE analysis = ?", (analysis,))
+
+    def append(self, analysis: str, outcome: str, results: pd.DataFrame) -> None:
+        """
+        Add one outcome's results (indexed by term), replacing any earlier
+        results for the same analysis / outcome
+        """
+        unknown_cols = [c for c in results.columns if c not in result_cols]
+        if len(unknown_cols) > 0:
+            raise ValueError(f"Can't store result columns: {unknown_cols}")
+
+        rows = [
+            (analysis, outcome, str(term), term_order)
+            + tuple(
+                float(stats[c]) if c in results.columns else None for c in result_cols
+            )
+            for term_order, (term, stats) in enumerate(results.iterrows())
+        ]
+
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM results WHERE analysis = ? AND outcome = ?",
+                (analysis, outcome),
+            )
+            conn.executemany(
+                f"INSERT INTO results VALUES ({', '.join('?' * (4 + len(result_cols)))})",
+                rows,
+            )
+
+    def _query(self, where: str, args: tuple) -> pd.DataFrame:
+        with self._connect() as conn:
+            return pd.read_sql_query(
+                f"SELECT * FROM results WHERE {where} "
+                "ORDER BY analysis, outcome, term_order",
+                conn,
+                params=args,
+            )
+
+    def load(self, analysis: str) -> pd.DataFrame:
+        """
+        All results for an analysis, in one read
+        """
+        return self._query("analysis = ?", (analysis,)).drop(columns="term_order")
+
+    def lookup(
+        self, analysis: str, term: str, outcomes: List[str] = None
+    ) -> pd.DataFrame:
+        """
+        A single term's results, indexed by outcome (in the order of outcomes,
+        if given)
+        """
+        results = self._query("analysis = ? AND term = ?", (analysis, term))
+        results = results.set_index("outcome")[result_cols]
+
+        if outcomes is not None:
+            missing = [o for o in outcomes if o not in results.index]
+            if len(missing) > 0:
+                raise KeyError(f"No {analysis} results for {term} in {missing}")
+
+            results = results.loc[outcomes]
+
+        return results
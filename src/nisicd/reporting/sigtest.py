@@ -5,40 +5,44 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import seaborn as sns
-import statsmodels.formula.api as sm
 from scipy.stats import ttest_ind
 from statsmodels.miscmodels.ordinal_model import OrderedModel
 from statsmodels.stats.proportion import proportions_ztest
 
 from nisicd import logging
-from nisicd.reporting import make_crosstab
+from nisicd.arrowCache import read_cache
+from nisicd.reporting import insurance_factor, insurance_term, make_crosstabs
+from nisicd.reporting.bootstrap import bootstrap_outcomes
+from nisicd.reporting.regression import fit_outcomes
+from nisicd.reporting.resultStore import ResultStore
+from nisicd.stageCache import StageCache
 
 
-def save_results(name: str, res_object):
+def save_results(store: ResultStore, name: str, res_out: pd.DataFrame):
     """
-    Because SM won't pickle
+    Add an outcome's odds ratio / CI / p-value frame (indexed by term) to the
+    result store
     """
-    odds_ratios = np.exp(res.params)
-    lower_ci = np.exp(res.conf_int()[0])
-    upper_ci = np.exp(res.conf_int()[1])
-    pvals = res.pvalues
-
-    res_out = pd.DataFrame(
-        {
-            "odds_ratio": odds_ratios,
-            "lower_ci": lower_ci,
-            "upper_ci": upper_ci,
-            "pval": pvals,
-        }
-    )
-
-    res_out.to_csv(f"results/{name}_regression.csv")
+    store.append("sigtest", name, res_out)
 
     return res_out
 
 
+# Bootstrap replicates for percentile / BCa CIs next to the Wald CIs. Off by
+# default, as it takes the stage from seconds to minutes; set e.g. 2000 to opt in
+bootstrap_reps = 0
+bootstrap_seed = 42
+
 if __name__ == "__main__":
-    all_df = pd.read_parquet("cache/processed.parquet")
+    stage_cache = StageCache(
+        "sigtest",
+        inputs=["cache/processed.parquet", __file__],
+        outputs=["results/regression.db", "results/regression.csv"],
+        params={"bootstrap_reps": bootstrap_reps, "bootstrap_seed": bootstrap_seed},
+    )
+    stage_cache.skip_if_fresh()
+
+    all_df = read_cache("cache/processed.parquet")
 
     # Binarize outcome columns so that we can just do logistic regression
     all_df["APRDRG_Severity"] = (all_df["APRDRG_Severity"] > 1).astype(int)
@@ -66,8 +70,43 @@ if __name__ == "__main__":
     logging.info(f"# of admissions in insured group: {len(insured_df)}")
     logging.info(f"# of admissions in uninsured group: {len(uninsured_df)}")
 
+    drg_cols = ["APRDRG_Severity", "APRDRG_Risk_Mortality", "cci_score"]
+    outcome_cols = ["SSI", "DIED", "PROLONGED_LOS", "OR_RETURN"]
+
+    for outcome_col in outcome_cols:
+        assert insured_df[outcome_col].apply(lambda x: x == 0 or x == 1).all()
+        assert uninsured_df[outcome_col].apply(lambda x: x == 0 or x == 1).all()
+
+    # Age-adjusted, every model shares the same right-hand side
+    rhs = f"{insurance_factor} + "
+    rhs += " + ".join(controllable_vars)
+
+    # res = OrderedModel.from_formula(formula_str, combined_df, distr="probit").fit(
+    #     method="bfgs", disp=0
+    # )
+    # Every covariate but AGE is categorical, so rows collapse to a few thousand
+    # covariate patterns and the binomial fit on counts gives identical estimates
+    fit_results = fit_outcomes(
+        combined_df, drg_cols + outcome_cols, rhs, backend="irls", aggregate=True
+    )
+
+    if bootstrap_reps > 0:
+        boot_results = bootstrap_outcomes(
+            combined_df,
+            drg_cols + outcome_cols,
+            rhs,
+            n_boot=bootstrap_reps,
+            seed=bootstrap_seed,
+        )
+
+        for col, boot_cis in boot_results.items():
+            fit_results[col] = pd.concat([fit_results[col], boot_cis], axis=1)
+
+    store = ResultStore("results/regression.db")
+    store.clear("sigtest")
+
     # Signficance of difference between APDRGs (insured vs uninsured)
-    for drg_col in ["APRDRG_Severity", "APRDRG_Risk_Mortality", "cci_score"]:
+    for drg_col in drg_cols:
         stat, pval = ttest_ind(
             insured_df[drg_col].to_numpy(), uninsured_df[drg_col].to_numpy()
         )
@@ -78,65 +117,37 @@ if __name__ == "__main__":
         #     f"T-Test {drg_col} (insured vs uninsured): {insured_avg:.2f} vs {uninsured_avg:.2f}, {pval:.5f}"
         # )
 
-        # Age-adjusted
-        formula_str = (
-            f"{drg_col} ~ C(InsuranceStatus, Treatment(reference='uninsured')) + "
-        )
-
-        formula_str += " + ".join(controllable_vars)
-        # res = OrderedModel.from_formula(formula_str, combined_df, distr="probit").fit(
-        #     method="bfgs", disp=0
-        # )
-        res = sm.logit(formula_str, combined_df).fit()
-        pvals = res.pvalues
-        assert "InsuranceStatus" in pvals.index[1]
+        res_out = fit_results[drg_col]
+        pval = res_out.loc[insurance_term, "pval"]
 
         logging.info(
-            f"{drg_col} adjusted p-values (insured, {insured_avg:.2f} vs uninsured, {uninsured_avg:.2f}): {pvals[0]}"
+            f"{drg_col} adjusted p-values (insured, {insured_avg:.2f} vs uninsured, {uninsured_avg:.2f}): {pval}"
         )
 
-        out_df = save_results(drg_col, res)
+        out_df = save_results(store, drg_col, res_out)
 
         print(out_df)
 
-    for outcome_col in ["SSI", "DIED", "PROLONGED_LOS", "OR_RETURN"]:
-        assert insured_df[outcome_col].apply(lambda x: x == 0 or x == 1).all()
-        assert uninsured_df[outcome_col].apply(lambda x: x == 0 or x == 1).all()
+    crosstabs = make_crosstabs(
+        combined_df, "InsuranceStatus", outcome_cols, exposed_value="insured"
+    )
 
-        crosstab = make_crosstab(insured_df, uninsured_df, outcome_col=outcome_col)
+    for outcome_col in outcome_cols:
+        crosstab = crosstabs[outcome_col]
         # logging.info(
         #     f"Odds ratio (insured vs uninsured) for {outcome_col}: {crosstab.oddsratio:.2f} (p {crosstab.oddsratio_pvalue():.4f})"
         # )
 
-        # Do age-adjusted LR
-        formula_str = (
-            f"{outcome_col} ~ C(InsuranceStatus, Treatment(reference='uninsured')) + "
-        )
-        formula_str += " + ".join(controllable_vars)
-
-        lr_df = combined_df
-        lr_df[outcome_col] = lr_df[outcome_col].astype(int)
-        lr = sm.logit(formula_str, data=lr_df)
-
-        try:
-            res = lr.fit(disp=0)
-        except np.linalg.LinAlgError as e:
-            logging.warning(
-                f"LR fit failed ({e}) for {outcome_col}. Attempting regularized fit"
-            )
-            res = lr.fit_regularized(disp=0)
-
-        odds_ratios = np.exp(res.params)
-        lower_ci = np.exp(res.conf_int()[0])
-        upper_ci = np.exp(res.conf_int()[1])
-        pvals = res.pvalues
-
-        # Double check insurance status OR / pval is @ index 1
-        assert "InsuranceStatus" in odds_ratios.index[1]
-        assert "InsuranceStatus" in pvals.index[1]
+        res_out = fit_results[outcome_col]
+        insurance_res = res_out.loc[insurance_term]
 
         logging.info(
-            f"Adjusted odds ratio for {outcome_col}: {odds_ratios[1]:.2f} [{lower_ci[1]:.2f}, {upper_ci[1]:.2f}], (p {pvals[1]:.5f})"
+            f"Adjusted odds ratio for {outcome_col}: {insurance_res['odds_ratio']:.2f} [{insurance_res['lower_ci']:.2f}, {insurance_res['upper_ci']:.2f}], (p {insurance_res['pval']:.5f})"
         )
 
-        save_results(outcome_col, res)
+        save_results(store, outcome_col, res_out)
+
+    # Human-readable copy of everything in the store
+    store.load("sigtest").to_csv("results/regression.csv", index=False)
+
+    stage_cache.commit()
@@ -1,15 +1,140 @@
 import string
 from dataclasses import dataclass
+from typing import List
 
 import docx
 import numpy as np
 import pandas as pd
 
+from nisicd.arrowCache import read_cache
 from nisicd.dataProcessing import categorical_lookup, composite_comorbidities
 from nisicd.reporting.docUtil import DocTable
+from nisicd.stageCache import StageCache
+
+
+@dataclass
+class T1Column:
+    df_col: str
+    name: str
+    type: str
+
+
+def get_t1_stats(
+    df: pd.DataFrame,
+    group_col: str,
+    groups: List[str],
+    t1_columns: List[T1Column],
+    total_label: str = "All",
+) -> pd.DataFrame:
+    """
+    Tidy Table 1 stats: one row per group, column and level (categorical
+    columns have one level per value present, others a single "" level)
+
+    Every column is turned into numeric indicators / values up front, so all
+    groups' counts, means and SDs come out of one groupby aggregation, plus the
+    same aggregation over all groups together for the total
+    """
+    in_groups = df[group_col].isin(groups).to_numpy()
+    group = df.loc[in_groups, group_col].astype(object).to_numpy()
+
+    values, levels = dict(), list()
+    for t1_col in t1_columns:
+        col = df.loc[in_groups, t1_col.df_col]
+
+        if t1_col.type == "categorical":
+            if isinstance(col.dtype, pd.CategoricalDtype):
+                col = col.astype(col.cat.categories.dtype)
+
+            for level in sorted(col.unique()):
+                levels.append((t1_col.df_col, level))
+                values[len(values)] = (col == level).to_numpy(dtype=int)
+        elif t1_col.type == "binary":
+            if not col.isin([0, 1]).all():
+                raise ValueError(f"Binary column {t1_col.df_col} isn't 0 / 1")
+
+            levels.append((t1_col.df_col, ""))
+            values[len(values)] = col.to_numpy(dtype=int)
+        elif t1_col.type == "continuous":
+            levels.append((t1_col.df_col, ""))
+            values[len(values)] = col.to_numpy(dtype=float)
+        else:
+            raise ValueError(f"Can't handle this type: {t1_col.type}")
+
+    data = pd.DataFrame(values)
+    aggs = ["sum", "mean", "std"]
+
+    stats = pd.concat(
+        [
+            data.agg(aggs).unstack().to_frame(total_label).T,
+            data.groupby(group).agg(aggs),
+        ]
+    )
+    stats = stats.rename_axis(index="group", columns=["idx", None]).stack(level=0)
+
+    stats = stats.join(
+        pd.DataFrame(levels, columns=["variable", "level"]).rename_axis("idx"),
+        on="idx",
+    )
+    group_sizes = pd.Series(group).value_counts()
+    group_sizes[total_label] = len(group)
+    stats["n"] = stats.index.get_level_values("group").map(group_sizes)
+
+    return stats.reset_index()[
+        ["group", "variable", "level", "n", "sum", "mean", "std"]
+    ]
+
+
+def format_t1_value(
+    stat: pd.Series,
+    col_type: str,
+    sd_sep: str = "±",
+    count_format: str = "",
+    use_sem: bool = False,
+) -> str:
+    """
+    Mean / SD (or SEM) for continuous columns, otherwise count (%)
+    """
+    if col_type == "continuous":
+        spread = stat["std"] / np.sqrt(stat["n"]) if use_sem else stat["std"]
+        return f"{stat['mean']:.2f}{sd_sep}{spread:.2f}"
+
+    return f"{int(stat['sum']):{count_format}} ({100 * stat['sum'] / stat['n']:.2f})"
+
+
+def get_t1_csv(group_stats: pd.DataFrame, t1_columns: List[T1Column]) -> pd.DataFrame:
+    """
+    Single-group Table 1 in the t1_*.csv layout: a row label and "N (%)",
+    with mean +/- SEM for continuous columns
+    """
+    rows = dict()
+
+    for t1_col in t1_columns:
+        for (variable, level), stat in group_stats.loc[[t1_col.df_col]].iterrows():
+            if t1_col.type == "continuous":
+                label = f"{t1_col.name} mean"
+            elif t1_col.type == "categorical":
+                label = f"[{variable}] {level}"
+            else:
+                label = t1_col.name
+
+            rows[label] = format_t1_value(stat, t1_col.type, " +/- ", ",", use_sem=True)
+
+    return pd.Series(rows, name="N (%)").to_frame()
+
 
 if __name__ == "__main__":
-    processed_df = pd.read_parquet("cache/processed.parquet")
+    stage_cache = StageCache(
+        "table1",
+        inputs=["cache/processed.parquet", __file__],
+        outputs=[
+            "results/table1.docx",
+            "results/t1_insured.csv",
+            "results/t1_uninsured.csv",
+        ],
+    )
+    stage_cache.skip_if_fresh()
+
+    processed_df = read_cache("cache/processed.parquet")
 
     # Some initial cleaning
     processed_df["condition"] = processed_df["condition"].apply(
@@ -18,21 +143,6 @@ if __name__ == "__main__":
 
     processed_df["CCI > 0"] = processed_df["cci_score"] > 0
 
-    combined_df = processed_df[
-        (processed_df["PAY1"] == "Private insurance")
-        | (processed_df["PAY1"] == "Self-pay")
-    ]
-    insured_df = processed_df[processed_df["PAY1"] == "Private insurance"]
-    uninsured_df = processed_df[processed_df["PAY1"] == "Self-pay"]
-
-    assert len(combined_df) == (len(insured_df) + len(uninsured_df))
-
-    @dataclass
-    class T1Column:
-        df_col: str
-        name: str
-        type: str
-
     ordered_t1_columns = [
         T1Column("AGE", "Age -- yr.", "continuous"),
         T1Column("RACE", "Race", "categorical"),
@@ -51,79 +161,99 @@ if __name__ == "__main__":
         T1Column("SSI", "In-hospital Surgical Site Infection", "binary"),
     ]
 
+    # Table columns: all (both groups) first, then each group
+    t1_groups = {
+        "All": "All",
+        "Private insurance": "Private Insurance Group",
+        "Self-pay": "Self-pay Group",
+    }
+
+    t1_stats = get_t1_stats(
+        processed_df, "PAY1", ["Private insurance", "Self-pay"], ordered_t1_columns
+    )
+    group_stats = {
+        group: t1_stats[t1_stats["group"] == group].set_index(["variable", "level"])
+        for group in t1_groups.keys()
+    }
+
     dt = DocTable(
-        [
-            "Characteristic",
-            f"All (n={len(combined_df)})",
-            f"Private Insurance Group (n={len(insured_df)})",
-            f"Self-pay Group (n={len(uninsured_df)})",
+        ["Characteristic"]
+        + [
+            f"{header} (n={group_stats[group]['n'].iloc[0]})"
+            for group, header in t1_groups.items()
         ]
     )
 
+    rows = list()
     for t1_col in ordered_t1_columns:
+        col_stats = {
+            group: stats.loc[[t1_col.df_col]] for group, stats in group_stats.items()
+        }
 
-        if t1_col.type == "continuous":
-            all_mean = combined_df[t1_col.df_col].mean()
-            all_std = combined_df[t1_col.df_col].std()
-
-            insured_mean = insured_df[t1_col.df_col].mean()
-            insured_std = insured_df[t1_col.df_col].std()
+        if t1_col.type == "categorical":
+            rows.append([t1_col.name])
 
-            uninsured_mean = uninsured_df[t1_col.df_col].mean()
-            uninsured_std = uninsured_df[t1_col.df_col].std()
-
-            dt.add_row(
-                [
-                    t1_col.name,
-                    f"{all_mean:.2f}±{all_std:.2f}",
-                    f"{insured_mean:.2f}±{insured_std:.2f}",
-                    f"{uninsured_mean:.2f}±{uninsured_std:.2f}",
+            for variable, level in col_stats["All"].index:
+                rows.append(
+                    [f"  {level}"]
+                    + [
+                        format_t1_value(stats.loc[(variable, level)], t1_col.type)
+                        for stats in col_stats.values()
+                    ]
+                )
+        else:
+            rows.append(
+                [t1_col.name]
+                + [
+                    format_t1_value(stats.iloc[0], t1_col.type)
+                    for stats in col_stats.values()
                 ]
             )
 
-        elif t1_col.type == "categorical":
-            dt.add_row([t1_col.name])
+    dt.add_rows(rows)
+    dt.save("results/table1.docx")
 
-            all_vcs = combined_df[t1_col.df_col].value_counts().sort_index().to_dict()
-            insured_vcs = (
-                insured_df[t1_col.df_col].value_counts().sort_index().to_dict()
-            )
-            uninsured_vcs = (
-                uninsured_df[t1_col.df_col].value_counts().sort_index().to_dict()
-            )
+    # Per-group summaries, each only listing the levels present in that group
+    processed_df["AGE > 65"] = (processed_df["AGE"] > 65).astype(int)
+    for aprdrg_col in ["APRDRG_Severity", "APRDRG_Risk_Mortality"]:
+        processed_df[f"{aprdrg_col} > 2"] = (processed_df[aprdrg_col] > 2).astype(int)
+    for c in composite_comorbidities.keys():
+        processed_df[f"{c} > 0"] = (processed_df[c] > 0).astype(int)
 
-            for label, all_count in all_vcs.items():
-                if label not in insured_vcs:
-                    insured_vcs[label] = 0
+    csv_t1_columns = (
+        [
+            T1Column("AGE", "Age", "continuous"),
+            T1Column("AGE > 65", "AGE > 65", "binary"),
+            T1Column("APRDRG_Severity > 2", "APRDRG_Severity > 2", "binary"),
+            T1Column(
+                "APRDRG_Risk_Mortality > 2", "APRDRG_Risk_Mortality > 2", "binary"
+            ),
+        ]
+        + [
+            T1Column(c, c, "categorical")
+            for c in [
+                "SEX",
+                "RACE",
+                "PAY1",
+                "HOSP_LOCTEACH",
+                "HOSP_REGION",
+                "INCOME_QRTL",
+            ]
+        ]
+        + [
+            T1Column(c, c, "binary")
+            for c in ["SSI", "PROLONGED_LOS", "DIED", "OR_RETURN"]
+        ]
+        # Comorbidities present from either of their source columns
+        + [T1Column(f"{c} > 0", c, "binary") for c in composite_comorbidities.keys()]
+    )
 
-                if label not in uninsured_vcs:
-                    uninsured_vcs[label] = 0
+    for group, fname in [("Private insurance", "insured"), ("Self-pay", "uninsured")]:
+        csv_stats = get_t1_stats(processed_df, "PAY1", [group], csv_t1_columns)
+        csv_stats = csv_stats[csv_stats["group"] == group].set_index(
+            ["variable", "level"]
+        )
 
-                dt.add_row(
-                    [
-                        f"  {label}",
-                        f"{all_count} ({100* all_count / len(combined_df):.2f})",
-                        f"{insured_vcs[label]} ({100* insured_vcs[label] / len(insured_df):.2f})",
-                        f"{uninsured_vcs[label]} ({100*uninsured_vcs[label] / len(uninsured_df):.2f})",
-                    ]
-                )
-        elif t1_col.type == "binary":
-            for df in [combined_df, insured_df, uninsured_df]:
-                assert df[t1_col.df_col].apply(lambda x: x == 1 or x == 0).all()
-
-            all_count = combined_df[t1_col.df_col].sum()
-            insured_count = insured_df[t1_col.df_col].sum()
-            uninsured_count = uninsured_df[t1_col.df_col].sum()
-
-            dt.add_row(
-                [
-                    t1_col.name,
-                    f"{all_count} ({100 * all_count / len(combined_df):.2f})",
-                    f"{insured_count} ({100 * insured_count / len(insured_df):.2f})",
-                    f"{uninsured_count} ({100 * uninsured_count / len(uninsured_df):.2f})",
-                ]
-            )
-        else:
-            raise ValueError(f"Can't handle this type: {t1_col.type}")
+        get_t1_csv(csv_stats, csv_t1_columns).to_csv(f"results/t1_{fname}.csv")
 
-    dt.save("results/table1.docx")
+    stage_cache.commit()
@@ -1,8 +1,16 @@
-import pandas as pd
-
+from nisicd.reporting import insurance_term
 from nisicd.reporting.docUtil import DocTable
+from nisicd.reporting.resultStore import ResultStore
+from nisicd.stageCache import StageCache
 
 if __name__ == "__main__":
+    stage_cache = StageCache(
+        "table3",
+        inputs=["results/regression.db", __file__],
+        outputs=["results/table3.docx"],
+    )
+    stage_cache.skip_if_fresh()
+
     # Table 3
     table3_dt = DocTable(
         [
@@ -14,26 +22,27 @@ if __name__ == "__main__":
         ]
     )
 
-    for comorbidity_measure in ["DIED", "OR_RETURN", "PROLONGED_LOS", "SSI"]:
-        results = pd.read_csv(
-            f"results/{comorbidity_measure}_regression.csv", index_col=0
-        )
-
-        # Insurance status should be first
-        assert results.index[1].startswith("C(InsuranceStatus,")
+    outcomes = ["DIED", "OR_RETURN", "PROLONGED_LOS", "SSI"]
+    insurance_results = ResultStore("results/regression.db").lookup(
+        "sigtest", insurance_term, outcomes
+    )
 
+    rows = list()
+    for comorbidity_measure, results in insurance_results.iterrows():
         formatted_for_table = [comorbidity_measure]
 
         for cname in ["odds_ratio", "lower_ci", "upper_ci"]:
-            formatted_for_table.append(f"{results.iloc[1][cname]:.2f}")
+            formatted_for_table.append(f"{results[cname]:.2f}")
 
-        pval = results.iloc[1]["pval"]
+        pval = results["pval"]
 
         if pval < 0.001:
             formatted_for_table.append("< 0.001")
         else:
             formatted_for_table.append(f"{pval:.3f}")
 
-        table3_dt.add_row(formatted_for_table)
+        rows.append(formatted_for_table)
 
+    table3_dt.add_rows(rows)
     table3_dt.save("results/table3.docx")
+    stage_cache.commit()
@@ -0,0 +1,220 @@
+"""
+Content-addressed cache for pipeline stages
+
+Each stage is keyed by a hash of its input files, its stage parameters (code
+sets, column lists, model specs...) and the source of every nisicd module
+loaded when the stage is set up, i.e. the stage script and everything it
+imports from the package. A stage whose
+key and outputs match what was recorded in the manifest the last time it ran
+can be skipped.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+from typing import Dict, List
+
+from nisicd import logging
+
+MANIFEST_PATH = "cache/manifest.json"
+
+
+def hash_params(params) -> str:
+    """
+    Stable hash of any JSON-serializable stage parameters
+    """
+    return hashlib.sha256(
+        json.dumps(params, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def get_source_files() -> List[str]:
+    """
+    Source files of the nisicd modules loaded in this process
+    """
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    module_files = [
+        getattr(module, "__file__", None) for module in list(sys.modules.values())
+    ]
+
+    return sorted(
+        {
+            os.path.abspath(f)
+            for f in module_files
+            if f is not None
+            and f.endswith(".py")
+            and os.path.abspath(f).startswith(package_dir + os.sep)
+        }
+    )
+
+
+def get_versioned_dir(root: str, fname: str, digest: str) -> str:
+    """
+    Per-file cache directory, named for the file's stem and a content digest
+    """
+    stem = os.path.splitext(os.path.basename(fname))[0]
+    return os.path.join(root, f"{stem}-{digest[:16]}")
+
+
+def reset_stale_dirs(dirs: Dict[str, str]) -> List[str]:
+    """
+    Files (keys of dirs, mapping each to its get_versioned_dir) whose directory
+    isn't complete, i.e. has no _SUCCESS marker. Each of these is recreated
+    empty, and other versions of the same file's directory are deleted: only
+    names of the stem plus exactly 16 hex digits match, so NIS_2014's
+    versions never include e.g. NIS_2014-core's
+    """
+    stale = [f for f, d in dirs.items() if not is_complete(d)]
+
+    for fname in stale:
+        root, name = os.path.split(dirs[fname])
+        version_pattern = re.compile(rf"{re.escape(name[:-17])}-[0-9a-f]{{16}}")
+
+        if os.path.isdir(root):
+            for old_name in os.listdir(root):
+                if version_pattern.fullmatch(old_name):
+                    shutil.rmtree(os.path.join(root, old_name))
+
+        os.makedirs(dirs[fname])
+
+    return stale
+
+
+def is_complete(path: str) -> bool:
+    return os.path.exists(os.path.join(path, "_SUCCESS"))
+
+
+def mark_complete(path: str) -> None:
+    open(os.path.join(path, "_SUCCESS"), "w").close()
+
+
+class StageCache:
+    def __init__(
+        self,
+        stage: str,
+        inputs: List[str] = [],
+        outputs: List[str] = [],
+        params: dict = {},
+        manifest_path: str = MANIFEST_PATH,
+    ) -> None:
+        self.stage = stage
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params
+        self.sources = get_source_files()
+        self.manifest_path = manifest_path
+        self.manifest = self._load_manifest()
+
+    def _load_manifest(self) -> dict:
+        if not os.path.exists(self.manifest_path):
+            return {"files": dict(), "stages": dict()}
+
+        with open(self.manifest_path, "r") as f:
+            return json.load(f)
+
+    def _save_manifest(self) -> None:
+        """
+        Merge our entries into whatever is on disk (other stages may have run
+        concurrently) under an exclusive lock, then atomically replace
+        """
+        os.makedirs(os.path.dirname(self.manifest_path) or ".", exist_ok=True)
+
+        with open(f"{self.manifest_path}.lock", "w") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+
+            on_disk = self._load_manifest()
+            on_disk["files"].update(self.manifest["files"])
+            on_disk["stages"][self.stage] = self.manifest["stages"][self.stage]
+
+            tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(on_disk, f, indent=2, sort_keys=True)
+
+            os.replace(tmp_path, self.manifest_path)
+            self.manifest = on_disk
+
+    def file_digest(self, path: str) -> str:
+        """
+        sha256 of a file's contents. Raw NIS files are large, so digests are
+        memoized in the manifest against (size, mtime) and only recomputed when
+        those change
+        """
+        stat = os.stat(path)
+        memo_key = os.path.abspath(path)
+        memo = self.manifest["files"].get(memo_key)
+
+        if (
+            memo is not None
+            and memo["size"] == stat.st_size
+            and memo["mtime_ns"] == stat.st_mtime_ns
+        ):
+            return memo["digest"]
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+
+        self.manifest["files"][memo_key] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "digest": digest.hexdigest(),
+        }
+
+        return digest.hexdigest()
+
+    @property
+    def source_digests(self) -> dict:
+        return {p: self.file_digest(p) for p in self.sources}
+
+    @property
+    def key(self) -> str:
+        return hash_params(
+            {
+                "stage": self.stage,
+                "inputs": {p: self.file_digest(p) for p in sorted(self.inputs)},
+                "params": hash_params(self.params),
+                "sources": self.source_digests,
+            }
+        )
+
+    def is_fresh(self) -> bool:
+        """
+        Same key as the last recorded run, and outputs untouched since then
+        """
+        recorded = self.manifest["stages"].get(self.stage)
+
+        if recorded is None or recorded["key"] != self.key:
+            return False
+
+        for path in self.outputs:
+            if not os.path.exists(path):
+                return False
+            elif self.file_digest(path) != recorded["outputs"].get(path):
+                return False
+
+        return True
+
+    def skip_if_fresh(self) -> None:
+        """
+        Exit the calling stage script early if there's nothing to do
+        """
+        if self.is_fresh():
+            logging.info(f"[*] {self.stage} is up to date, skipping")
+            sys.exit(0)
+
+    def commit(self) -> None:
+        """
+        Record a successful run of this stage
+        """
+        self.manifest["stages"][self.stage] = {
+            "key": self.key,
+            "inputs": {p: self.file_digest(p) for p in self.inputs},
+            "sources": self.source_digests,
+            "outputs": {p: self.file_digest(p) for p in self.outputs},
+        }
+
+        self._save_manifest()
@@ -0,0 +1,47 @@
+import matplotlib
+import pandas as pd
+
+matplotlib.use("Agg")
+
+from nisicd.reporting.forestPlot import hash_frame, save_forest
+
+
+def get_grid_results() -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "payer": ["Private insurance", "Self-pay"] * 2,
+            "dependent_var": ["DIED", "DIED", "SSI", "SSI"],
+            "OR": [0.9, 1.1, 1.2, 0.8],
+            "lower_ci": [0.7, 0.9, 1.0, 0.6],
+            "upper_ci": [1.1, 1.3, 1.4, 1.0],
+        }
+    )
+
+
+def test_hash_ignores_index():
+    df = get_grid_results()
+
+    assert hash_frame(df) == hash_frame(df.set_axis([3, 1, 0, 2]))
+    assert hash_frame(df) != hash_frame(df.iloc[::-1].reset_index(drop=True))
+
+
+def test_reordered_input_is_cache_hit(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    plot_kwargs = dict(label_col="payer", group_col="dependent_var", or_col="OR")
+
+    df = get_grid_results()
+    # Same rows in a different order, as grid results could come back
+    shuffled_df = df.sample(frac=1, random_state=0)
+
+    assert save_forest(
+        df.sort_values(["dependent_var", "payer"]), "fig.png", **plot_kwargs
+    )
+    assert not save_forest(
+        shuffled_df.sort_values(["dependent_var", "payer"]), "fig.png", **plot_kwargs
+    )
+
+    # Different data is re-rendered
+    df.loc[0, "OR"] = 0.95
+    assert save_forest(
+        df.sort_values(["dependent_var", "payer"]), "fig.png", **plot_kwargs
+    )
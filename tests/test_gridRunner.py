@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+
+from nisicd.reporting.gridRunner import GridSpec, grid_columns, run_grid
+
+
+def get_df(n: int = 400) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=n)
+
+    return pd.DataFrame(
+        {
+            "PAY1": rng.choice(["Private insurance", "Self-pay"], size=n),
+            "x": x,
+            "SSI": rng.binomial(1, 1 / (1 + np.exp(-x))),
+        }
+    )
+
+
+def test_empty_subgroup_gets_empty_cells(tmp_path):
+    spec = GridSpec("PAY1", ["Private insurance", "Medicare"], ["SSI"], ["x"])
+    out_path = tmp_path / "grid.csv"
+
+    run_grid(get_df(), spec, out_path, max_workers=1, scratch_dir=tmp_path)
+    results = pd.read_csv(out_path)
+
+    assert list(results.columns) == grid_columns
+    assert results["payer"].to_list() == ["Private insurance", "Medicare"]
+    assert results.loc[0, ["OR", "lower_ci", "upper_ci", "pval"]].notna().all()
+    assert results.loc[1, ["OR", "lower_ci", "upper_ci", "pval"]].isna().all()
+
+
+def test_empty_grid_writes_header(tmp_path):
+    spec = GridSpec("PAY1", [], ["SSI"], ["x"])
+    out_path = tmp_path / "grid.csv"
+
+    run_grid(get_df(), spec, out_path, max_workers=1, scratch_dir=tmp_path)
+    results = pd.read_csv(out_path)
+
+    assert list(results.columns) == grid_columns
+    assert len(results) == 0
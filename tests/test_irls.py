@@ -0,0 +1,27 @@
+import numpy as np
+
+from nisicd.reporting.irls import fit_logistic
+
+
+def test_failed_step_halving_is_not_converged():
+    rng = np.random.default_rng(0)
+    X = np.column_stack([np.ones(200), rng.normal(size=200)])
+    y = rng.binomial(1, 0.3, size=200)
+
+    res = fit_logistic(X, y, max_halvings=0)
+
+    assert not res.converged
+    assert np.all(res.params == 0)
+
+
+def test_fit_matches_known_solution():
+    rng = np.random.default_rng(0)
+    X = np.column_stack([np.ones(500), rng.normal(size=500)])
+    y = rng.binomial(1, 1 / (1 + np.exp(-(0.5 - X[:, 1]))))
+
+    res = fit_logistic(X, y)
+
+    # Score equations hold at the MLE
+    p = 1 / (1 + np.exp(-(X @ res.params.to_numpy())))
+    assert res.converged
+    assert np.allclose(X.T @ (y - p), 0, atol=1e-6)
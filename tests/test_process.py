@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from nisicd.dataProcessing.process import LosQuantileSketch, get_los_thresholds
+
+
+def test_sketch_matches_groupby_quantile():
+    rng = np.random.default_rng(0)
+    condition = pd.Series(rng.choice(["a", "b", "c"], size=5000))
+    los = pd.Series(rng.poisson(4, size=5000).astype(float))
+
+    # Uneven chunks, merged across two sketches
+    first, second = LosQuantileSketch(), LosQuantileSketch()
+    for start, stop in [(0, 7), (7, 1234), (1234, 3000)]:
+        first.update(condition[start:stop], los[start:stop])
+    second.update(condition[3000:], los[3000:])
+    first.merge(second)
+
+    for q in [0.5, 0.75, 0.9, 0.95]:
+        assert first.quantiles(q) == get_los_thresholds(condition, los, q)
+
+
+# Linearly interpolated quantiles, worked out by hand: a's LOS is 1, 2, 3, 4, 10
+# and b's is 2, 2, 5, 8 (e.g. a at 0.9 is 4 + 0.6 * (10 - 4))
+hand_thresholds = {
+    0.5: {"a": 3.0, "b": 3.5},
+    0.75: {"a": 4.0, "b": 5.75},
+    0.9: {"a": 7.6, "b": 7.1},
+}
+
+
+@pytest.mark.parametrize("q", hand_thresholds.keys())
+def test_thresholds_by_hand(q):
+    condition = pd.Series(["a", "b", "a", "b", "a", "a", "b", "a", "b"])
+    los = pd.Series([10, 2, 3, 8, 1, 4, 2, 2, 5], dtype=float)
+
+    sketch = LosQuantileSketch()
+    sketch.update(condition[:4], los[:4])
+    sketch.update(condition[4:], los[4:])
+
+    assert get_los_thresholds(condition, los, q) == pytest.approx(hand_thresholds[q])
+    assert sketch.quantiles(q) == pytest.approx(hand_thresholds[q])
+
+
+def test_empty_sketch():
+    assert LosQuantileSketch().quantiles(0.75) == dict()
@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+
+from nisicd.reporting.regression import build_design, formula_columns
+
+
+def test_formula_columns_quoted_names():
+    cols = ["AGE", "CANCER", "CANCER, SOLID", "HYPERTENSION 1", "RACE", "uninsured"]
+    formula = (
+        "C(RACE, Treatment(reference='uninsured')) + "
+        "Q('CANCER, SOLID') + Q(\"HYPERTENSION 1\")"
+    )
+
+    assert formula_columns(cols, formula) == ["CANCER, SOLID", "HYPERTENSION 1", "RACE"]
+
+
+def test_formula_columns_no_partial_matches():
+    cols = ["AGE", "AGE_GROUP", "SSI", "C"]
+
+    assert formula_columns(cols, "SSI ~ C(AGE_GROUP)") == ["AGE_GROUP", "SSI"]
+
+
+def test_build_design_quoted_categorical():
+    df = pd.DataFrame(
+        {
+            "CANCER, SOLID": pd.Categorical(["no", "yes", "no", "yes"]),
+            "AGE": np.arange(4.0),
+        }
+    )
+
+    design = build_design(df, "C(Q('CANCER, SOLID')) + AGE")
+
+    assert len(design) == 4
+    assert design.shape[1] == 3
@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from nisicd.reporting import make_crosstab, make_crosstabs
+
+
+def test_crosstabs_match_make_crosstab():
+    df = pd.DataFrame(
+        {
+            "exposed": [1, 1, 1, 0, 0, 0, 0],
+            "SSI": [1, 0, 0, 1, 1, 0, 0],
+            "DIED": [0, 0, 1, 0, 0, 0, 1],
+        }
+    )
+
+    crosstabs = make_crosstabs(df, "exposed", ["SSI", "DIED"])
+
+    for c in ["SSI", "DIED"]:
+        expected = make_crosstab(df[df["exposed"] == 1], df[df["exposed"] == 0], c)
+        np.testing.assert_array_equal(crosstabs[c].table, expected.table)
+
+
+@pytest.mark.parametrize("bad_value", [256, np.nan, 2])
+def test_crosstabs_reject_non_binary_outcomes(bad_value):
+    df = pd.DataFrame({"exposed": [1, 0, 0], "SSI": [1, 0, bad_value]})
+
+    with pytest.raises(ValueError, match="SSI"):
+        make_crosstabs(df, "exposed", ["SSI"])
@@ -0,0 +1,33 @@
+import os
+
+from nisicd.stageCache import (
+    get_versioned_dir,
+    is_complete,
+    mark_complete,
+    reset_stale_dirs,
+)
+
+
+def test_reset_stale_dirs_only_drops_versions_of_the_same_file(tmp_path):
+    root = str(tmp_path)
+    old = get_versioned_dir(root, "data/NIS_2014.parquet", "0" * 64)
+    other = get_versioned_dir(root, "data/NIS_2014-core.parquet", "1" * 64)
+    for d in [old, other]:
+        os.makedirs(d)
+        mark_complete(d)
+
+    new = get_versioned_dir(root, "data/NIS_2014.parquet", "2" * 64)
+    assert reset_stale_dirs({"data/NIS_2014.parquet": new}) == ["data/NIS_2014.parquet"]
+
+    assert not os.path.exists(old)
+    assert is_complete(other)
+    assert os.path.isdir(new) and not is_complete(new)
+
+
+def test_complete_dirs_are_kept(tmp_path):
+    d = get_versioned_dir(str(tmp_path), "NIS_2015.parquet", "3" * 64)
+    os.makedirs(d)
+    mark_complete(d)
+
+    assert reset_stale_dirs({"NIS_2015.parquet": d}) == []
+    assert is_complete(d)